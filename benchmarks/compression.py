@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compressed size and time of a PutMetricData request per gzip level - the
+# request is the first one of an instance with 40 disks reporting disk
+# space and I/O with --aggregated and --auto-scaling (basis of
+# COMPRESS_LEVEL in cloudwatchmon/publisher.py).
+#
+#   python benchmarks/compression.py [--disks N] [--runs N]
+
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from cloudwatchmon.cli.put_instance_stats import Metrics
+from cloudwatchmon.publisher import API_VERSION, gzip_compress
+from cloudwatchmon.put_metric_data import BatchPacker, NAMESPACE
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+DISK_METRICS = [
+    ('DiskSpaceUtilization', 'Percent'), ('DiskSpaceUsed', 'Gigabytes'),
+    ('DiskSpaceAvailable', 'Gigabytes'), ('InodeUtilization', 'Percent'),
+    ('DiskReadOps', 'Count/Second'), ('DiskWriteOps', 'Count/Second'),
+    ('DiskReadBytes', 'Bytes/Second'), ('DiskWriteBytes', 'Bytes/Second'),
+    ('DiskReadLatency', 'Milliseconds'), ('DiskWriteLatency', 'Milliseconds'),
+    ('DiskQueueLength', 'Count')
+]
+
+
+def build_request(disks):
+    metrics = Metrics('eu-west-1', 'i-0123456789abcdef0', 'm5.2xlarge',
+                      'ami-0123456789abcdef0', 'additional', 'web-production')
+    for disk in range(disks):
+        for idx, (name, unit) in enumerate(DISK_METRICS):
+            metrics.add_metric(name, unit, 12.5 + disk * 0.37 + idx * 3.1,
+                               '/data/volume{0:02d}'.format(disk),
+                               '/dev/nvme{0}n1'.format(disk + 1))
+
+    packer = BatchPacker()
+    batches = []
+    for datum in metrics.datums(datetime.datetime.utcnow()):
+        batches.extend(packer.add(datum))
+    batches.extend(packer.flush())
+
+    params = batches[0].params(NAMESPACE)
+    params['Action'] = 'PutMetricData'
+    params['Version'] = API_VERSION
+    return urlencode(sorted(params.items())).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compression benchmark')
+    parser.add_argument('--disks', type=int, default=40)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    body = build_request(args.disks)
+    print('Request: {0:.0f} KB'.format(len(body) / 1024.0))
+    for level in range(1, 10):
+        size = len(gzip_compress(body, level))
+        seconds = min(timeit.repeat(lambda: gzip_compress(body, level),
+                                    number=1, repeat=args.runs))
+        print('level {0}: {1:7} bytes {2:5.1f}% {3:6.1f} ms'.format(
+            level, size, 100.0 * size / len(body), seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
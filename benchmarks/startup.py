@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Times fresh interpreter runs of both scripts until main() is called and
+# fails if modules that are only needed to talk to AWS were imported by
+# --version or --verify. Runs anywhere - instance metadata comes from a
+# local stand-in server.
+#
+#   python benchmarks/startup.py [--runs N] [--max-ms MS]
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# must not be imported without talking to AWS
+HEAVY_MODULES = ['boto', 'pkg_resources', 'http.client', 'httplib']
+
+METADATA = {
+    'placement/availability-zone': 'eu-west-1a',
+    'instance-id': 'i-0123456789abcdef0',
+    'instance-type': 't3.micro',
+    'ami-id': 'ami-12345678'
+}
+
+CASES = [
+    ('mon-get-instance-stats.py --version',
+     'cloudwatchmon.cli.get_instance_stats', ['--version']),
+    ('mon-put-instance-stats.py --version',
+     'cloudwatchmon.cli.put_instance_stats', ['--version']),
+    ('mon-put-instance-stats.py --verify',
+     'cloudwatchmon.cli.put_instance_stats',
+     ['--mem-util', '--disk-space-util', '--disk-path=/', '--verify'])
+]
+
+CHILD = '''
+import sys, time
+t = time.time()
+import importlib
+m = importlib.import_module(sys.argv[1])
+import_ms = (time.time() - t) * 1000
+sys.argv = sys.argv[1:]
+try:
+    m.main()
+except SystemExit:
+    pass
+heavy = [n for n in {0!r} if n in sys.modules]
+sys.stdout.write('\\nRESULT %f %s\\n' % (import_ms, ','.join(heavy)))
+'''.format(HEAVY_MODULES)
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        self.__reply(b'token')
+
+    def do_GET(self):
+        value = METADATA.get(self.path[len('/latest/meta-data/'):])
+        if value is None:
+            self.send_error(404)
+        else:
+            self.__reply(value.encode('utf-8'))
+
+    def __reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(module, args, env):
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', CHILD, module] +
+                                  args, env=env, cwd=ROOT)
+    wall_ms = (time.time() - start) * 1000
+    result = out.decode('utf-8').rstrip().split('\n')[-1].split(' ')
+    heavy = result[2].split(',') if len(result) > 2 else []
+    return float(result[1]), wall_ms, heavy
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float,
+                        help='Fails if the median time to main() is higher.')
+    args = parser.parse_args()
+
+    server = HTTPServer(('127.0.0.1', 0), MetadataHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    cache_dir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['AWS_EC2CW_META_DATA'] = cache_dir
+    env['AWS_EC2_METADATA_SERVICE_ENDPOINT'] = \
+        'http://127.0.0.1:{0}'.format(server.server_port)
+    env['PYTHONPATH'] = ROOT
+
+    failed = False
+    try:
+        # the metadata is cached after the first run like on an instance
+        run(CASES[-1][1], CASES[-1][2], env)
+
+        for name, module, case_args in CASES:
+            import_ms = []
+            wall_ms = []
+            heavy = set()
+            for _ in range(args.runs):
+                i, w, h = run(module, case_args, env)
+                import_ms.append(i)
+                wall_ms.append(w)
+                heavy.update(h)
+
+            print('{0:40} to main() {1:6.1f} ms, process {2:6.1f} ms'
+                  .format(name, median(import_ms), median(wall_ms)))
+            if heavy:
+                print('  FAIL: imported ' + ', '.join(sorted(heavy)))
+                failed = True
+            if args.max_ms and median(import_ms) > args.max_ms:
+                print('  FAIL: slower than {0} ms'.format(args.max_ms))
+                failed = True
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
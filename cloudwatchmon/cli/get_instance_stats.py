@@ -19,16 +19,36 @@
 
 from __future__ import print_function
 from cloudwatchmon.cloud_watch_client import *
+from cloudwatchmon.get_metric_data import get_metric_data, \
+    metric_stat_query, search_query
+from cloudwatchmon.metric_cache import MetricDataCache
 
 import argparse
-import boto
-import boto.ec2.cloudwatch
+import csv
 import datetime
+import json
+import math
 import sys
 
 CLIENT_NAME = 'CloudWatch-GetInstanceStats'
 FileCache.CLIENT_NAME = CLIENT_NAME
 
+PERIOD = 300
+
+# Minimum and maximum of the periods are the overall minimum and maximum,
+# the average is weighted by the sample count of the periods
+STATISTICS = ['Minimum', 'Maximum', 'Sum', 'SampleCount']
+
+# title, namespace, metric, extra dimensions and dimensions looked up with
+# a SEARCH expression
+REPORTS = [
+    ('CPU Utilization', 'AWS/EC2', 'CPUUtilization', {}, None),
+    ('Memory Utilization', 'System/Linux', 'MemoryUtilization', {}, None),
+    ('Swap Utilization', 'System/Linux', 'SwapUtilization', {}, None),
+    ('Disk Space Utilization', 'System/Linux', 'DiskSpaceUtilization',
+     {'MountPath': '/'}, ['Filesystem'])
+]
+
 
 def config_parser():
     parser = argparse.ArgumentParser(
@@ -36,7 +56,9 @@ def config_parser():
         description='''
   Queries Amazon CloudWatch for statistics on CPU, memory, swap, and
   disk space utilization within a given time interval. This data is
-  provided for the Amazon EC2 instance on which this script is executed.
+  provided for the Amazon EC2 instance on which this script is executed,
+  or for a fleet of instances (--instance-ids, --auto-scaling-group) and
+  aggregated metrics (--aggregated-dimension).
 ''', epilog='''
 For more information on how to use this utility, see project home on GitHub:
 https://github.com/osiegmar/cloudwatch-mon-scripts-python
@@ -49,6 +71,52 @@ https://github.com/osiegmar/cloudwatch-mon-scripts-python
     parser.add_argument('--verbose',
                         action='store_true',
                         help='Displays details of what the script is doing.')
+
+    fleet_group = parser.add_argument_group('fleet report')
+    fleet_group.add_argument('--instance-ids',
+                             metavar='ID[,ID...]',
+                             action='append',
+                             help='Reports statistics of these instances, may be given multiple times.')
+    fleet_group.add_argument('--auto-scaling-group',
+                             metavar='NAME',
+                             action='append',
+                             help='Reports statistics of the instances in this Auto Scaling group, may be given multiple times.')
+    fleet_group.add_argument('--aggregated-dimension',
+                             metavar='NAME=VALUE',
+                             action='append',
+                             help='Reports aggregated statistics (see --aggregated and --auto-scaling of mon-put-instance-stats.py) for this dimension, e.g. InstanceType=t2.micro or AutoScalingGroupName=web, may be given multiple times.')
+    fleet_group.add_argument('--region',
+                             help='Specifies the region of the fleet (default: region of this instance).')
+    fleet_group.add_argument('--format',
+                             choices=['table', 'csv', 'json'],
+                             default='table',
+                             help='Specifies the output format of the fleet report.')
+    fleet_group.add_argument('--sort-by',
+                             metavar='COLUMN',
+                             default='target',
+                             help='Sorts the fleet report by target, average, minimum, maximum or a percentile (e.g. p90), highest first.')
+    fleet_group.add_argument('--percentile',
+                             metavar='PERCENT',
+                             type=float,
+                             action='append',
+                             help='Reports this percentile of the 5 minute averages, may be given multiple times (default: 50, 90 and 99).')
+    fleet_group.add_argument('--connections',
+                             metavar='COUNT',
+                             type=int,
+                             default=4,
+                             help='Specifies the number of parallel requests to CloudWatch.')
+    cache_group = parser.add_argument_group('data point cache')
+    cache_group.add_argument('--cache-max-size',
+                             metavar='MEGABYTES',
+                             type=float,
+                             default=50,
+                             help='Specifies the size of the local cache of fetched data points, 0 disables the cache (default: 50).')
+    cache_group.add_argument('--cache-settle-time',
+                             metavar='MINUTES',
+                             type=int,
+                             default=15,
+                             help='Specifies the time after which data points are cached as final (default: 15).')
+
     parser.add_argument('--version',
                         action='store_true',
                         help='Displays the version number and exits.')
@@ -56,60 +124,267 @@ https://github.com/osiegmar/cloudwatch-mon-scripts-python
     return parser
 
 
-def print_metric_stats(region, instance_id, namespace, metric, title,
-                       recent_hours, verbose, xdims=None, conn=None):
-    boto_debug = 2 if verbose else 0
-
-    if not conn:
-        # TODO add timeout
-        conn = boto.ec2.cloudwatch.connect_to_region(region, debug=boto_debug)
-
-        if not conn:
-            raise IOError('Could not establish connection to CloudWatch service')
-
-    end_time = datetime.datetime.utcnow()
-    start_time = end_time - datetime.timedelta(hours=recent_hours)
-    dims = {'InstanceId': instance_id}
-    if xdims:
-        dims.update(xdims)
-    metrics = conn.get_metric_statistics(300, start_time, end_time,
-                                         metric, namespace,
-                                         ['Average', 'Maximum', 'Minimum'],
-                                         dims)
+def get_queries(dims, prefix=''):
+    # dims select the instance or aggregate (e.g. InstanceType) to report
+    queries = []
+    for idx, (title, namespace, metric, xdims, search_dims) in \
+            enumerate(REPORTS):
+        metric_dims = dict(dims)
+        metric_dims.update(xdims)
+        for stat in STATISTICS:
+            query_id = '{0}m{1}_{2}'.format(prefix, idx, stat.lower())
+            if search_dims:
+                queries.append(search_query(query_id, namespace,
+                                            list(metric_dims) + search_dims,
+                                            metric, metric_dims, stat,
+                                            PERIOD))
+            else:
+                queries.append(metric_stat_query(query_id, namespace, metric,
+                                                 metric_dims, stat, PERIOD))
+    return queries
+
+
+def get_values(results, query_id):
+    # values of all series returned for a query
+    return [value for points in results.get(query_id, {}).values()
+            for _, value in points]
+
+
+def percentile(values, p):
+    # nearest rank of sorted values
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class Summary:
+    def __init__(self):
+        self.sum = 0.0
+        self.sample_count = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.averages = []
+
+    def add(self, results, prefix):
+        # adds the series of the queries with the given id prefix, the
+        # series a SEARCH expression returns are combined
+        periods = {}
+        for stat in 'sum', 'samplecount':
+            for points in results.get(prefix + stat, {}).values():
+                for timestamp, value in points:
+                    period = periods.setdefault(timestamp, [0.0, 0.0])
+                    period[stat == 'samplecount'] += value
+        for total, count in periods.values():
+            if count:
+                self.sum += total
+                self.sample_count += count
+                self.averages.append(total / count)
+
+        for value in get_values(results, prefix + 'minimum'):
+            self.__add_extremes(value, None)
+        for value in get_values(results, prefix + 'maximum'):
+            self.__add_extremes(None, value)
+
+    def __add_extremes(self, minimum, maximum):
+        if minimum is not None and (self.minimum is None or
+                                    minimum < self.minimum):
+            self.minimum = minimum
+        if maximum is not None and (self.maximum is None or
+                                    maximum > self.maximum):
+            self.maximum = maximum
+
+    def merge(self, other):
+        self.sum += other.sum
+        self.sample_count += other.sample_count
+        self.averages.extend(other.averages)
+        self.__add_extremes(other.minimum, other.maximum)
+
+    def average(self):
+        if not self.sample_count:
+            return None
+        return self.sum / self.sample_count
+
+    def percentiles(self, percentiles):
+        # percentiles of the period averages
+        values = sorted(self.averages)
+        return [percentile(values, p) if values else None
+                for p in percentiles]
+
+
+def print_metric_stats(results, idx, title, optional):
+    summary = Summary()
+    summary.add(results, 'm{0}_'.format(idx))
+
+    if not summary.sample_count and optional:
+        # e.g. the root filesystem is not reported
+        return
 
     print(title)
 
-    if metrics:
-        max_val = max(m['Maximum'] for m in metrics)
-        min_val = min(m['Minimum'] for m in metrics)
-        avg_val = sum(m['Average'] for m in metrics) / float(len(metrics))
-
+    if summary.sample_count:
         print("    Average: {0:.2f}%, Minimum: {1:.2f}%, Maximum: {2:.2f}%\n"
-              .format(avg_val, min_val, max_val))
+              .format(summary.average(), summary.minimum, summary.maximum))
     else:
         print("    Average: N/A, Minimum: N/A, Maximum: N/A\n")
 
 
-def print_filesystem_stats(region, instance_id, namespace, metric, title,
-                           recent_hours, verbose):
+def get_auto_scaling_instances(client, group_name, verbose):
+    import boto.ec2.autoscale
+
     boto_debug = 2 if verbose else 0
 
-    # TODO add timeout
-    conn = boto.ec2.cloudwatch.connect_to_region(region, debug=boto_debug)
+    conn = boto.ec2.autoscale.connect_to_region(client.region,
+                                                debug=boto_debug)
 
     if not conn:
-        raise IOError('Could not establish connection to CloudWatch service')
+        raise IOError('Could not establish connection to Auto Scaling')
+
+    # the timeout and retries of the CloudWatch requests - boto waits 70
+    # seconds per attempt and tries 7 times by default
+    conn.http_connection_kwargs['timeout'] = client.read_timeout
+    conn.num_retries = client.max_retries
+
+    groups = conn.get_all_groups(names=[group_name])
+
+    if not groups:
+        raise ValueError('Could not find Auto Scaling group ' + group_name)
+
+    return [instance.instance_id for instance in groups[0].instances]
+
+
+def get_targets(args, client):
+    # (name, dimensions, instance) of everything to report on
+    instance_ids = []
+    for ids in args.instance_ids or []:
+        instance_ids.extend(i.strip() for i in ids.split(',') if i.strip())
+    for group_name in args.auto_scaling_group or []:
+        instance_ids.extend(get_auto_scaling_instances(client, group_name,
+                                                       args.verbose))
+
+    targets = []
+    seen = set()
+    for instance_id in instance_ids:
+        if instance_id not in seen:
+            seen.add(instance_id)
+            targets.append((instance_id, {'InstanceId': instance_id}, True))
+
+    for dimension in args.aggregated_dimension or []:
+        name, sep, value = dimension.partition('=')
+        if not sep or not name or not value:
+            raise ValueError('Invalid aggregated dimension: ' + dimension)
+        targets.append((dimension, {name: value}, False))
+
+    return targets
+
+
+def get_fleet_rows(args, results, targets):
+    # one row per target and metric, followed by the fleet rows of all
+    # instances
+    rows = []
+    fleet = [Summary() for _ in REPORTS]
+    instances = 0
+    for t, (name, dims, instance) in enumerate(targets):
+        instances += instance
+        for idx, report in enumerate(REPORTS):
+            summary = Summary()
+            summary.add(results, 't{0}_m{1}_'.format(t, idx))
+            if instance:
+                fleet[idx].merge(summary)
+            rows.append(to_row(args, name, idx, summary))
+
+    fleet_rows = []
+    if instances > 1:
+        fleet_rows = [to_row(args, 'fleet', idx, summary)
+                      for idx, summary in enumerate(fleet)]
+    return rows, fleet_rows
+
+
+def to_row(args, target, idx, summary):
+    row = {'target': target,
+           'metric': REPORTS[idx][2],
+           'average': summary.average(),
+           'minimum': summary.minimum,
+           'maximum': summary.maximum}
+    for p, value in zip(args.percentile,
+                        summary.percentiles(args.percentile)):
+        row[percentile_column(p)] = value
+    return row
+
+
+def percentile_column(p):
+    return 'p{0:g}'.format(p)
+
+
+def sort_rows(rows, sort_by):
+    if sort_by == 'target':
+        return rows
+    # per metric, highest first, rows without data last
+    metrics = [report[2] for report in REPORTS]
+    return sorted(rows, key=lambda row: (metrics.index(row['metric']),
+                                         row[sort_by] is None,
+                                         -(row[sort_by] or 0)))
+
+
+def print_fleet_report(args, columns, rows):
+    if args.format == 'json':
+        print(json.dumps([dict((c, row[c]) for c in columns) for row in rows],
+                         indent=2))
+    elif args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(['' if row[c] is None else row[c]
+                             for c in columns])
+    else:
+        lines = [columns]
+        for row in rows:
+            lines.append([row[c] if c in ('target', 'metric') else
+                          'N/A' if row[c] is None else
+                          '{0:.2f}'.format(row[c]) for c in columns])
+        widths = [max(len(line[i]) for line in lines)
+                  for i in range(len(columns))]
+        for line in lines:
+            print('  '.join(v.ljust(w) if i < 2 else v.rjust(w)
+                            for i, (v, w) in enumerate(zip(line, widths)))
+                  .rstrip())
+
+
+def report_fleet(args, fetch, client, region, start_time, end_time):
+    targets = get_targets(args, client)
+    if not targets:
+        raise ValueError('No instances found to report on.')
+
+    queries = []
+    for t, (name, dims, instance) in enumerate(targets):
+        queries.extend(get_queries(dims, 't{0}_'.format(t)))
 
-    dims = {'InstanceId': instance_id, 'MountPath': '/'}
-    metrics = conn.list_metrics(None, dims, metric, namespace)
+    results = fetch(client, queries, start_time, end_time)
+    rows, fleet_rows = get_fleet_rows(args, results, targets)
 
-    if metrics:
-        file_system = metrics[0].dimensions['Filesystem']
-        xdims = {'MountPath': '/', 'Filesystem': file_system}
-        print_metric_stats(region, instance_id,
-                           namespace,
-                           metric, title,
-                           recent_hours, verbose, xdims, conn)
+    columns = ['target', 'metric', 'average', 'minimum', 'maximum'] + \
+        [percentile_column(p) for p in args.percentile]
+    print_fleet_report(args, columns,
+                       sort_rows(rows, args.sort_by) + fleet_rows)
+
+
+def validate_args(args):
+    if args.percentile is None:
+        args.percentile = [50.0, 90.0, 99.0]
+    if any(p <= 0 or p > 100 for p in args.percentile):
+        raise ValueError('Percentiles must be between 0 and 100.')
+
+    columns = ['target', 'average', 'minimum', 'maximum'] + \
+        [percentile_column(p) for p in args.percentile]
+    if args.sort_by not in columns:
+        raise ValueError('Sort column must be one of: ' + ', '.join(columns))
+
+    if args.connections < 1:
+        raise ValueError('Connections must be positive.')
+
+    if args.cache_max_size < 0 or args.cache_settle_time < 0:
+        raise ValueError('Cache size and settle time must not be negative.')
+
+    return args.instance_ids or args.auto_scaling_group or \
+        args.aggregated_dimension
 
 
 def main():
@@ -122,34 +397,52 @@ def main():
         return 0
 
     try:
-        metadata = get_metadata()
+        fleet = validate_args(args)
+
+        from cloudwatchmon.publisher import Publisher
 
-        if args.verbose:
-            print('Instance metadata: ' + str(metadata))
+        end_time = datetime.datetime.utcnow()
+        start_time = end_time - datetime.timedelta(hours=args.recent_hours)
+
+        if fleet and args.region:
+            # no need to run on EC2
+            region = args.region
+        else:
+            metadata = get_metadata()
+
+            if args.verbose:
+                print('Instance metadata: ' + str(metadata))
+
+            region = args.region or \
+                metadata['placement']['availability-zone'][:-1]
+
+        client = Publisher(region, connections=args.connections,
+                           verbose=args.verbose)
+
+        if args.cache_max_size:
+            cache = MetricDataCache(
+                os.path.join(META_DATA_CACHE_DIR, CLIENT_NAME + '-data'),
+                int(args.cache_max_size * 1024 * 1024),
+                datetime.timedelta(minutes=args.cache_settle_time))
+            fetch = cache.get_metric_data
+        else:
+            fetch = get_metric_data
+
+        if fleet:
+            report_fleet(args, fetch, client, region, start_time, end_time)
+            return 0
 
-        region = metadata['placement']['availability-zone'][:-1]
         instance_id = metadata['instance-id']
 
         unit = 'hours' if args.recent_hours > 1 else 'hour'
         print('Instance {0} statistics for the last {1} {2}.\n'
               .format(instance_id, args.recent_hours, unit))
 
-        print_metric_stats(region, instance_id,
-                           'AWS/EC2',
-                           'CPUUtilization', 'CPU Utilization',
-                           args.recent_hours, args.verbose)
-        print_metric_stats(region, instance_id,
-                           'System/Linux',
-                           'MemoryUtilization', 'Memory Utilization',
-                           args.recent_hours, args.verbose)
-        print_metric_stats(region, instance_id,
-                           'System/Linux',
-                           'SwapUtilization', 'Swap Utilization',
-                           args.recent_hours, args.verbose)
-        print_filesystem_stats(region, instance_id,
-                               'System/Linux',
-                               'DiskSpaceUtilization', 'Disk Space Utilization',
-                               args.recent_hours, args.verbose)
+        results = fetch(client, get_queries({'InstanceId': instance_id}),
+                        start_time, end_time)
+
+        for idx, report in enumerate(REPORTS):
+            print_metric_stats(results, idx, report[0], report[4] is not None)
     except Exception as e:
         log_error(str(e), False)
         return 1
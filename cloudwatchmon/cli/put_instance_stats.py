@@ -19,22 +19,49 @@
 
 from __future__ import print_function
 from cloudwatchmon.cloud_watch_client import *
+from cloudwatchmon.emf import EmfWriter
+from cloudwatchmon.put_metric_data import BatchPacker, MetricDatum, \
+    NAMESPACE, StatisticSet, TIMESTAMP_FORMAT
+from cloudwatchmon.spool import Spool
+from cloudwatchmon.statsd import StatsdAggregator, StatsdListener
 
 import argparse
-import boto
-import boto.ec2.autoscale
-import boto.ec2.cloudwatch
+import csv
 import datetime
+import fnmatch
+import itertools
+import json
+import math
 import os
 import random
 import re
+import signal
 import sys
+import threading
 import time
-import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 CLIENT_NAME = 'CloudWatch-PutInstanceData'
 FileCache.CLIENT_NAME = CLIENT_NAME
-AWS_LIMIT_METRICS_SIZE = 20
+
+# Filesystems skipped by --disk-path=auto unless included by --fs-type-include
+PSEUDO_FS_TYPES = frozenset([
+    'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs',
+    'debugfs', 'devpts', 'devtmpfs', 'efivarfs', 'fusectl', 'hugetlbfs',
+    'mqueue', 'nsfs', 'overlay', 'pipefs', 'proc', 'pstore', 'ramfs',
+    'rpc_pipefs', 'securityfs', 'selinuxfs', 'sockfs', 'squashfs', 'sysfs',
+    'tmpfs', 'tracefs'
+])
+
+# FUSE filesystems (e.g. fuse.lxcfs, fuse.sshfs) are skipped as well
+PSEUDO_FS_TYPE_PREFIX = 'fuse.'
+
+# Disk stat jobs of previous runs that did not finish yet
+HANGING_DISK_JOBS = []
 
 SIZE_UNITS_CFG = {
     'bytes': {'name': 'Bytes', 'div': 1},
@@ -125,16 +152,171 @@ class LoadAverage:
         return loadavg_info
 
 
+class CpuData:
+    # user, nice, system, idle, iowait, irq, softirq, steal
+    # (guest time is already included in user and nice)
+    FIELDS = 8
+
+    def __init__(self, state):
+        cpu_times = self.__gather_cpu_times()
+        previous = state.swap('cpu', cpu_times) or {}
+        self.cpus = {}
+        for cpu, times in cpu_times.items():
+            prev_times = previous.get(cpu)
+            if prev_times and all(t >= p for t, p in zip(times, prev_times)):
+                times = [t - p for t, p in zip(times, prev_times)]
+            # else since boot (first sample, reboot or CPU hotplug)
+            self.cpus[cpu] = self.__utilization(times)
+
+    @staticmethod
+    def __gather_cpu_times():
+        cpu_times = {}
+        with open('/proc/stat') as f:
+            for line in f:
+                if line.startswith('cpu'):
+                    parsed = line.split()
+                    cpu_times[parsed[0]] = \
+                        [int(t) for t in parsed[1:CpuData.FIELDS + 1]]
+        return cpu_times
+
+    @staticmethod
+    def __utilization(times):
+        times = times + [0] * (CpuData.FIELDS - len(times))
+        user, nice, system, idle, iowait, irq, softirq, steal = times
+        total = float(sum(times)) or 1.0
+        return {'user': 100.0 * (user + nice) / total,
+                'system': 100.0 * (system + irq + softirq) / total,
+                'iowait': 100.0 * iowait / total,
+                'steal': 100.0 * steal / total,
+                'idle': 100.0 * idle / total}
+
+    def percpu(self):
+        return sorted((cpu for cpu in self.cpus if cpu != 'cpu'),
+                      key=lambda cpu: int(cpu[3:]))
+
+
 class Disk:
-    def __init__(self, mount, file_system, total, used, avail, inode_util):
+    def __init__(self, mount, file_system, total, used, avail, inode_util,
+                 device=None):
         self.mount = mount
         self.file_system = file_system
+        self.device = device
         self.used = used
         self.avail = avail
         self.util = 100.0 * used / total if total > 0 else 0
         self.inode_util = inode_util
 
 
+class Mount:
+    def __init__(self, device, root, mount_point, fs_type, source):
+        self.device = device
+        self.root = root
+        self.mount_point = mount_point
+        self.fs_type = fs_type
+        self.source = source
+
+
+class DiskIO:
+    SECTOR_SIZE = 512
+
+    def __init__(self, state):
+        deltas = counter_deltas(state, 'diskstats', self.__gather_diskstats())
+        self.devices = {}
+        for device, (stats, elapsed) in deltas.items():
+            if elapsed > 0:
+                self.devices[device] = self.__rates(stats, elapsed)
+
+    @staticmethod
+    def __gather_diskstats():
+        devices = {}
+        with open('/proc/diskstats') as f:
+            for line in f:
+                parsed = line.split()
+                # reads, sectors read, ms reading, writes, sectors written,
+                # ms writing, ms weighted by queue length
+                devices[parsed[0] + ':' + parsed[1]] = \
+                    [int(parsed[i]) for i in (3, 5, 6, 7, 9, 10, 13)]
+        return devices
+
+    @staticmethod
+    def __rates(stats, elapsed):
+        reads, read_sectors, read_ms, writes, write_sectors, write_ms, \
+            weighted_ms = stats
+        return {'read_ops': reads / elapsed,
+                'write_ops': writes / elapsed,
+                'read_bytes': read_sectors * DiskIO.SECTOR_SIZE / elapsed,
+                'write_bytes': write_sectors * DiskIO.SECTOR_SIZE / elapsed,
+                'read_latency': float(read_ms) / reads if reads else 0.0,
+                'write_latency': float(write_ms) / writes if writes else 0.0,
+                'queue_length': weighted_ms / 1000.0 / elapsed}
+
+
+class NetData:
+    def __init__(self, state):
+        deltas = counter_deltas(state, 'netdev', self.__gather_netdev())
+        self.interfaces = {}
+        for interface, (counters, elapsed) in deltas.items():
+            if elapsed > 0:
+                self.interfaces[interface] = [c / elapsed for c in counters]
+
+        tcp = counter_deltas(state, 'tcp', self.__gather_tcp())
+        retrans_segs, out_segs = tcp['tcp'][0]
+        self.tcp_retransmits = 0.0
+        if tcp['tcp'][1] > 0:
+            self.tcp_retransmits = retrans_segs / tcp['tcp'][1]
+        self.tcp_retransmit_ratio = \
+            100.0 * retrans_segs / out_segs if out_segs else 0.0
+
+    @staticmethod
+    def __gather_netdev():
+        interfaces = {}
+        with open('/proc/net/dev') as f:
+            for line in f.readlines()[2:]:
+                interface, counters = line.split(':', 1)
+                parsed = counters.split()
+                # bytes, packets, errors and drops received and transmitted
+                interfaces[interface.strip()] = \
+                    [int(parsed[i]) for i in (0, 1, 2, 3, 8, 9, 10, 11)]
+        return interfaces
+
+    @staticmethod
+    def __gather_tcp():
+        with open('/proc/net/snmp') as f:
+            tcp = [line.split()[1:] for line in f if line.startswith('Tcp:')]
+        counters = dict(zip(tcp[0], tcp[1]))
+        return {'tcp': [int(counters['RetransSegs']),
+                        int(counters['OutSegs'])]}
+
+
+class DiskStatJob:
+    def __init__(self, path, mount, discovered=False):
+        self.path = path
+        self.mount = mount
+        self.discovered = discovered
+        self.started = None
+        self.finished = False
+        self.disk = None
+        self.error = None
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.disk = stat_disk(self.path, self.mount)
+        except Exception as e:
+            self.error = e
+        self.finished = True
+
+
+class Process:
+    def __init__(self, pid, comm, cmdline, cpu_ticks, start_ticks, rss):
+        self.pid = pid
+        self.comm = comm
+        self.cmdline = cmdline
+        self.cpu_ticks = cpu_ticks
+        self.start_ticks = start_ticks
+        self.rss = rss
+
+
 class Metrics:
     def __init__(self, region, instance_id, instance_type, image_id,
                  aggregated, autoscaling_group_name):
@@ -142,6 +324,7 @@ class Metrics:
         self.units = []
         self.values = []
         self.dimensions = []
+        self.sample_index = {}
         self.region = region
         self.instance_id = instance_id
         self.instance_type = instance_type
@@ -149,8 +332,11 @@ class Metrics:
         self.aggregated = aggregated
         self.autoscaling_group_name = autoscaling_group_name
 
-    def add_metric(self, name, unit, value, mount=None, file_system=None):
+    def add_metric(self, name, unit, value, mount=None, file_system=None,
+                   extra_dims=None):
         common_dims = {}
+        if extra_dims:
+            common_dims.update(extra_dims)
         if mount:
             common_dims['MountPath'] = mount
         if file_system:
@@ -180,30 +366,115 @@ class Metrics:
             metric_dims.update(dim)
             self.dimensions.append(metric_dims)
 
-    def send(self, verbose, awsProfile):
-        boto_debug = 2 if verbose else 0
-
-        # TODO add timeout
-        conn = boto.ec2.cloudwatch.connect_to_region(self.region, profile_name=awsProfile,
-                                                     debug=boto_debug)
-
-        if not conn:
-            raise IOError('Could not establish connection to CloudWatch')
-
-        size = len(self.names)
-
-        for idx_start in range(0, size, AWS_LIMIT_METRICS_SIZE):
-            idx_end = idx_start + AWS_LIMIT_METRICS_SIZE
-            response = conn.put_metric_data('System/Linux',
-                                            self.names[idx_start:idx_end],
-                                            self.values[idx_start:idx_end],
-                                            datetime.datetime.utcnow(),
-                                            self.units[idx_start:idx_end],
-                                            self.dimensions[idx_start:idx_end])
-
-            if not response:
-                raise ValueError('Could not send data to CloudWatch - '
-                                 'use --verbose for more information')
+    def add_samples(self, samples):
+        # one statistic set per metric name, unit and dimensions
+        for i in range(0, len(samples.names)):
+            key = (samples.names[i], samples.units[i],
+                   tuple(sorted(samples.dimensions[i].items())))
+            idx = self.sample_index.get(key)
+            if idx is None:
+                idx = len(self.names)
+                self.sample_index[key] = idx
+                self.names.append(samples.names[i])
+                self.units.append(samples.units[i])
+                self.values.append(StatisticSet())
+                self.dimensions.append(samples.dimensions[i])
+            self.values[idx].add(samples.values[i])
+
+    def apply_deadband(self, deadbands, heartbeat, state):
+        # Drops metrics that did not move more than their deadband since
+        # they were sent last - unless that is heartbeat seconds ago.
+        # Returns the values to record with record_deadband() once sent.
+        now = time.time()
+        sent = {}
+        keep = []
+        for i in range(0, len(self.names)):
+            deadband = None
+            for pattern, threshold, relative in deadbands:
+                if fnmatch.fnmatchcase(self.names[i], pattern):
+                    deadband = threshold, relative
+                    break
+            if not deadband:
+                keep.append(i)
+                continue
+
+            value = self.values[i]
+            if isinstance(value, StatisticSet):
+                value = value.average()
+            value = float(value)
+
+            key = 'deadband:' + json.dumps(
+                [self.names[i], self.units[i],
+                 sorted(self.dimensions[i].items())])
+            last = state.get(key)
+            if last and now - last[1] < heartbeat:
+                threshold, relative = deadband
+                if relative:
+                    threshold = abs(last[0]) * threshold / 100.0
+                if abs(value - last[0]) <= threshold:
+                    continue
+
+            sent[key] = [value, now]
+            keep.append(i)
+
+        self.names = [self.names[i] for i in keep]
+        self.units = [self.units[i] for i in keep]
+        self.values = [self.values[i] for i in keep]
+        self.dimensions = [self.dimensions[i] for i in keep]
+        return sent
+
+    def datums(self, timestamp):
+        return [MetricDatum(self.names[i], self.units[i], self.dimensions[i],
+                            timestamp, self.values[i])
+                for i in range(0, len(self.names))]
+
+    def send(self, verbose, awsProfile, publisher=None, spool=None,
+             more_datums=None):
+        from cloudwatchmon.publisher import Publisher, is_transient
+
+        if not publisher:
+            publisher = Publisher(self.region, awsProfile, verbose=verbose)
+
+        datums = self.datums(datetime.datetime.utcnow())
+        if spool:
+            spooled = spool.take()
+            if verbose and spooled:
+                print('Replaying {0} spooled metrics'.format(len(spooled)))
+            datums = spooled + datums
+        if more_datums is not None:
+            datums = itertools.chain(datums, more_datums)
+
+        # batches are sent as soon as there is one per connection, so
+        # streamed metric data never piles up in memory
+        packer = BatchPacker()
+        pending = []
+        total = 0
+        failed = 0
+        error = None
+        for datum in itertools.chain(datums, [None]):
+            if datum is None:
+                pending.extend(packer.flush())
+            else:
+                pending.extend(packer.add(datum))
+            if len(pending) < publisher.connections and datum is not None:
+                continue
+
+            total += len(pending)
+            errors = publisher.send(pending, NAMESPACE)
+            pending = []
+            if errors:
+                failed += len(errors)
+                error = errors[0][1]
+            if spool:
+                spool.append([batch for batch, e in errors
+                              if is_transient(e)])
+
+        if spool:
+            spool.commit()
+
+        if failed:
+            raise IOError('Could not send {0} of {1} requests to CloudWatch '
+                          '- {2}'.format(failed, total, error))
 
     def __str__(self):
         ret = ''
@@ -219,12 +490,26 @@ def to_lower(s):
     return s.lower()
 
 
+def to_deadband(s):
+    pattern, sep, threshold = s.rpartition('=')
+    relative = threshold.endswith('%')
+    try:
+        threshold = float(threshold.rstrip('%'))
+    except ValueError:
+        sep = None
+    if not sep or not pattern or threshold < 0:
+        raise argparse.ArgumentTypeError(
+            'invalid deadband: {0} (expected NAME=DELTA or NAME=PERCENT%)'
+            .format(s))
+    return pattern, threshold, relative
+
+
 def config_parser():
     size_units = ['bytes', 'kilobytes', 'megabytes', 'gigabytes']
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description='''
-  Collects memory, swap, and disk space utilization on an Amazon EC2 instance
+  Collects memory, swap, CPU, and disk space utilization on an Amazon EC2 instance
   and sends this data as custom metrics to Amazon CloudWatch.''', epilog='''
 Supported UNITS are bytes, kilobytes, megabytes, and gigabytes.
 
@@ -241,6 +526,23 @@ Examples
     */5 * * * * mon-put-instance-stats.py --mem-util --disk-space-util --disk-path=/ --from-cron
 
 
+  To keep running and report memory utilization every minute
+
+    mon-put-instance-stats.py --mem-util --daemon --interval=60
+
+
+  To report disk space utilization of all mounted ext4 and xfs filesystems
+  except those mounted below /mnt/scratch
+
+    mon-put-instance-stats.py --disk-space-util --disk-path=auto --fs-type-include=ext4 --fs-type-include=xfs --mount-exclude='/mnt/scratch/*'
+
+
+  To report disk space utilization only if it changed by more than one percent
+  point, but at least every 15 minutes
+
+    mon-put-instance-stats.py --disk-space-util --disk-path=/ --deadband=DiskSpaceUtilization=1 --heartbeat=900
+
+
   To report metrics from file
 
     mon-put-instance-stats.py --from-file filename.csv
@@ -252,7 +554,7 @@ https://github.com/osiegmar/cloudwatch-mon-scripts-python
     parser.add_argument('--from-file',
                         metavar='FILENAME',
                         action='append',
-                        help='Add metrics from file, the metrics data must be in csv format (name,unit,value)')
+                        help='Add metrics from file (- for stdin), may be given multiple times. The metrics data must be in csv format (name,unit,value[,timestamp][,dimension=value...]), the optional timestamp in seconds since the epoch or ISO 8601 UTC (2015-01-31T12:00:00Z)')
 
     memory_group = parser.add_argument_group('memory metrics')
     memory_group.add_argument('--mem-util',
@@ -288,11 +590,46 @@ https://github.com/osiegmar/cloudwatch-mon-scripts-python
                                action='store_true',
                                help='Report load averages for 1min, 5min and 15min divided by the number of CPU cores.')
 
+    cpu_group = parser.add_argument_group('cpu metrics')
+    cpu_group.add_argument('--cpu',
+                           action='store_true',
+                           help='Reports user, system, iowait, steal and idle CPU time in percentages.')
+    cpu_group.add_argument('--cpu-percore',
+                           action='store_true',
+                           help='Reports CPU time metrics for every CPU core.')
+
+    net_group = parser.add_argument_group('network metrics')
+    net_group.add_argument('--net',
+                           action='store_true',
+                           help='Reports bytes, packets, errors and drops per second for each '
+                                'network interface and TCP retransmits.')
+    net_group.add_argument('--net-interface',
+                           metavar='PATTERN',
+                           action='append',
+                           help='Only report network interfaces matching this pattern. '
+                                'Glob pattern or regular expression prefixed with "re:".')
+    net_group.add_argument('--net-interface-exclude',
+                           metavar='PATTERN',
+                           action='append',
+                           help='Skip network interfaces matching this pattern (default: lo). '
+                                'Glob pattern or regular expression prefixed with "re:".')
+
     disk_group = parser.add_argument_group('disk metrics')
     disk_group.add_argument('--disk-path',
                             metavar='PATH',
                             action='append',
-                            help='Selects the disk by the path on which to report.')
+                            help='Selects the disk by the path on which to report. '
+                                 'Use "auto" to report all mounted filesystems.')
+    disk_group.add_argument('--fs-type-include',
+                            metavar='PATTERN',
+                            action='append',
+                            help='Only report filesystems of this type with --disk-path=auto. '
+                                 'Glob pattern or regular expression prefixed with "re:".')
+    disk_group.add_argument('--mount-exclude',
+                            metavar='PATTERN',
+                            action='append',
+                            help='Skip mount points matching this pattern with --disk-path=auto. '
+                                 'Glob pattern or regular expression prefixed with "re:".')
     disk_group.add_argument('--disk-space-util',
                             action='store_true',
                             help='Reports disk space utilization in percentages.')
@@ -311,12 +648,40 @@ https://github.com/osiegmar/cloudwatch-mon-scripts-python
     disk_group.add_argument('--disk-inode-util',
                             action='store_true',
                             help='Reports disk inode utilization in percentages.')
+    disk_group.add_argument('--disk-io',
+                            action='store_true',
+                            help='Reports read and write operations, throughput, latency '
+                                 'and queue length of the block device.')
+    disk_group.add_argument('--disk-timeout',
+                            metavar='SECONDS',
+                            type=float,
+                            default=5.0,
+                            help='Skips a disk that does not respond within SECONDS '
+                                 '(e.g. a hanging NFS mount).')
+    disk_group.add_argument('--disk-workers',
+                            metavar='COUNT',
+                            type=int,
+                            default=4,
+                            help='Specifies the number of disks collected in parallel.')
 
     process_group = parser.add_argument_group('process metrics')
     process_group.add_argument('--process-name',
                                metavar='PROCNAME',
                                action='append',
                                help='Report process count, CPU utilization, and memory utilization metrics for a process.')
+    process_group.add_argument('--process-match-cmdline',
+                               action='store_true',
+                               help='Match process names against the full command line instead of the command name.')
+
+    statsd_group = parser.add_argument_group('statsd metrics')
+    statsd_group.add_argument('--statsd',
+                              metavar='ADDRESS',
+                              help='Receives StatsD counters, gauges, timers and sets on a UDP address ([HOST]:PORT, e.g. 127.0.0.1:8125) or a Unix datagram socket (unix:PATH) in daemon mode and reports them aggregated every interval.')
+    statsd_group.add_argument('--statsd-percentile',
+                              metavar='PERCENT',
+                              type=float,
+                              action='append',
+                              help='Reports this percentile of StatsD timers, may be given multiple times (default: 90 and 99).')
 
     exclusive_group = parser.add_mutually_exclusive_group()
     exclusive_group.add_argument('--from-cron',
@@ -338,6 +703,81 @@ https://github.com/osiegmar/cloudwatch-mon-scripts-python
                         const='additional',
                         nargs='?',
                         help='Adds aggregated metrics for Auto Scaling group.')
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='Keeps running and reports metrics every interval.')
+    parser.add_argument('--interval',
+                        metavar='SECONDS',
+                        type=int,
+                        default=60,
+                        help='Specifies the reporting interval in daemon mode.')
+    parser.add_argument('--sample-interval',
+                        metavar='SECONDS',
+                        type=int,
+                        help='Samples metrics every SECONDS in daemon mode and '
+                             'reports them aggregated as statistic sets '
+                             '(count, sum, minimum, maximum) every interval.')
+    parser.add_argument('--collect-timeout',
+                        metavar='SECONDS',
+                        type=float,
+                        default=30.0,
+                        help='Limits the time spent collecting metrics, metrics '
+                             'collected until then are still reported (default: 30, 0 disables the limit).')
+    parser.add_argument('--emf',
+                        metavar='TARGET',
+                        help='Writes metrics in CloudWatch Embedded Metric Format to TARGET (- for stdout, a file, tcp://HOST:PORT or udp://HOST:PORT, e.g. the CloudWatch agent at tcp://127.0.0.1:25888) instead of sending them to CloudWatch.')
+    parser.add_argument('--metrics-listen',
+                        metavar='ADDRESS',
+                        help='Serves the latest collected metrics in OpenMetrics text format on http://ADDRESS/metrics in daemon mode ([HOST]:PORT, e.g. 127.0.0.1:9101).')
+    parser.add_argument('--endpoint-url',
+                        metavar='URL',
+                        help='Sends metrics to this CloudWatch endpoint instead of the '
+                             'regional default (e.g. a VPC endpoint).')
+    parser.add_argument('--connections',
+                        metavar='COUNT',
+                        type=int,
+                        default=4,
+                        help='Specifies the number of parallel connections to CloudWatch.')
+    parser.add_argument('--connect-timeout',
+                        metavar='SECONDS',
+                        type=float,
+                        default=3.0,
+                        help='Specifies the timeout for connecting to CloudWatch.')
+    parser.add_argument('--read-timeout',
+                        metavar='SECONDS',
+                        type=float,
+                        default=10.0,
+                        help='Specifies the timeout for CloudWatch responses.')
+    parser.add_argument('--max-retries',
+                        metavar='COUNT',
+                        type=int,
+                        default=4,
+                        help='Retries throttled and failed requests up to COUNT times.')
+    parser.add_argument('--compress',
+                        metavar='MIN_BYTES',
+                        type=int,
+                        const=4096,
+                        nargs='?',
+                        help='Compresses requests to CloudWatch of at least MIN_BYTES '
+                             '(default 4096) with gzip.')
+    parser.add_argument('--spool-max-size',
+                        metavar='MEGABYTES',
+                        type=float,
+                        default=10,
+                        help='Keeps metrics that could not be sent in a spool of this size '
+                             'and sends them with the next report (0 to disable).')
+    parser.add_argument('--deadband',
+                        metavar='NAME=DELTA',
+                        type=to_deadband,
+                        action='append',
+                        help='Only sends metrics matching NAME (glob pattern) if they moved '
+                             'more than DELTA (absolute, or relative if suffixed by %%) '
+                             'since they were sent last.')
+    parser.add_argument('--heartbeat',
+                        metavar='SECONDS',
+                        type=int,
+                        default=300,
+                        help='Sends metrics with deadband at least every SECONDS.')
     parser.add_argument('--verify',
                         action='store_true',
                         help='Checks configuration and prepares a remote call.')
@@ -383,43 +823,304 @@ def add_loadavg_metrics(args, metrics):
         metrics.add_metric('LoadAvgPerCPU15Min', None, loadavg.loadavg_percpu_15min)
 
 
-def get_disk_info(args):
-    paths = args.disk_path
-    df_out = [s.split() for s in
-              os.popen('/bin/df -k -P ' +
-                       ' '.join(paths)).read().splitlines()]
+def unescape_mount_field(field):
+    # mountinfo escapes space, tab, newline and backslash as octal
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def read_mounts():
+    mounts = []
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            sep = fields.index('-', 6)
+            mounts.append(Mount(fields[2],
+                                unescape_mount_field(fields[3]),
+                                unescape_mount_field(fields[4]),
+                                fields[sep + 1],
+                                unescape_mount_field(fields[sep + 2])))
+    return mounts
+
+
+def find_mount(path, mounts):
+    path = os.path.realpath(path)
+    found = None
+    # later entries shadow earlier ones mounted on the same path
+    for mount in mounts:
+        mount_point = mount.mount_point.rstrip('/') + '/'
+        if path == mount.mount_point or path.startswith(mount_point) \
+                or mount.mount_point == '/':
+            if not found or \
+                    len(mount.mount_point) >= len(found.mount_point):
+                found = mount
+    return found
+
+
+def stat_disk(path, mount):
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        raise ValueError('Disk file path ' + path +
+                         ' does not exist or cannot be accessed.')
+
+    total = st.f_blocks * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    avail = st.f_bavail * st.f_frsize
+    inodes_used = st.f_files - st.f_ffree
+    inode_util = 100.0 * inodes_used / st.f_files if st.f_files > 0 else 0
+    return Disk(mount.mount_point, mount.source, total, used, avail,
+                inode_util, mount.device)
+
+
+def compile_patterns(patterns):
+    regexes = []
+    for pattern in patterns:
+        if pattern.startswith('re:'):
+            regexes.append('(?:' + pattern[3:] + r')\Z')
+        else:
+            regexes.append(fnmatch.translate(pattern))
+    try:
+        return re.compile('|'.join(regexes))
+    except re.error as e:
+        raise ValueError('Invalid pattern: ' + str(e))
+
+
+def discover_mounts(args, mounts):
+    fs_type_include = None
+    mount_exclude = None
+    if args.fs_type_include:
+        fs_type_include = compile_patterns(args.fs_type_include)
+    if args.mount_exclude:
+        mount_exclude = compile_patterns(args.mount_exclude)
+
+    # only the last mount stacked on a mount point is visible
+    visible = {}
+    for mount in mounts:
+        visible[mount.mount_point] = mount
+
+    by_device = {}
+    for mount in mounts:
+        if visible[mount.mount_point] is not mount:
+            continue
+
+        if fs_type_include:
+            if not fs_type_include.match(mount.fs_type):
+                continue
+        elif (mount.fs_type in PSEUDO_FS_TYPES and
+              not (mount.fs_type == 'overlay' and
+                   mount.mount_point == '/')) or \
+                mount.fs_type.startswith(PSEUDO_FS_TYPE_PREFIX):
+            # an overlay root is the disk of a container, other overlays
+            # are the root of containers running here
+            continue
+
+        if mount_exclude and mount_exclude.match(mount.mount_point):
+            continue
+
+        # bind mounts share the device - prefer the mount of the fs root
+        known = by_device.get(mount.device)
+        if not known or (known.root != '/' and mount.root == '/'):
+            by_device[mount.device] = mount
+
+    return sorted(by_device.values(), key=lambda m: m.mount_point)
+
+
+def disk_worker(jobs, done):
+    while True:
+        try:
+            job = jobs.get_nowait()
+        except queue.Empty:
+            return
+        job.run()
+        done.put(job)
+
+
+def stat_disks(args, jobs, deadline):
+    HANGING_DISK_JOBS[:] = [job for job in HANGING_DISK_JOBS
+                            if not job.finished]
+    hanging = set(job.mount.mount_point for job in HANGING_DISK_JOBS)
+
+    todo = queue.Queue()
+    done = queue.Queue()
+    pending = []
+    for job in jobs:
+        # a hanging statvfs() can't be interrupted - don't pile up threads
+        if job.mount.mount_point in hanging:
+            log_error('Disk ' + job.path + ' is still not responding, '
+                      'skipped.', args.from_cron)
+            continue
+        todo.put(job)
+        pending.append(job)
+
+    workers = min(args.disk_workers, len(pending))
+    for _ in range(workers):
+        worker = threading.Thread(target=disk_worker, args=(todo, done))
+        worker.daemon = True
+        worker.start()
+
+    timed_out = 0
+    while pending:
+        now = time.time()
+        timeout = args.disk_timeout
+        for job in pending:
+            if job.started is not None:
+                timeout = min(timeout, job.started + args.disk_timeout - now)
+        if deadline is not None:
+            timeout = min(timeout, deadline - now)
+
+        try:
+            pending.remove(done.get(timeout=max(timeout, 0)))
+            continue
+        except queue.Empty:
+            pass
+
+        now = time.time()
+        for job in list(pending):
+            if (deadline is not None and now >= deadline) or \
+                    (job.started is not None and
+                     now >= job.started + args.disk_timeout):
+                pending.remove(job)
+                if job.started is not None:
+                    HANGING_DISK_JOBS.append(job)
+                    timed_out += 1
+                log_error('Disk ' + job.path + ' did not respond within the '
+                          'timeout, skipped.', args.from_cron)
+
+        if timed_out >= workers and pending:
+            # all workers hang - queued disks would never start
+            while True:
+                try:
+                    todo.get_nowait()
+                except queue.Empty:
+                    break
+            for job in list(pending):
+                if job.started is None:
+                    pending.remove(job)
+                    log_error('Disk ' + job.path + ' skipped, all disk '
+                              'workers are hanging.', args.from_cron)
+
     disks = []
-    for line in df_out[1:]:
-        mount = line[5]
-        file_system = line[0]
-        total = int(line[1]) * 1024
-        used = int(line[2]) * 1024
-        avail = int(line[3]) * 1024
-        disks.append(Disk(mount, file_system, total, used, avail, 0))
-
-    # Gather inode utilization if it is requested
-    if not args.disk_inode_util:
-        return disks
-
-    df_inode_out = [s.split() for s in
-                    os.popen('/bin/df -i -k -P ' +
-                             ' '.join(paths)).read().splitlines()]
-    disks_inode_util = []
-    for line in df_inode_out[1:]:
-        used = float(line[2])
-        total = float(line[1])
-        inode_util_val = 100.0 * used / total if total > 0 else 0
-        disks_inode_util.append(inode_util_val)
-
-    for index, disk in enumerate(disks):
-        disk.inode_util = disks_inode_util[index]
+    for job in jobs:
+        if job in HANGING_DISK_JOBS or not job.finished:
+            continue
+        if job.error:
+            if not job.discovered:
+                raise job.error
+            # e.g. unmounted meanwhile or not accessible to root (FUSE)
+            log_error('Disk ' + job.path + ' cannot be accessed, skipped.',
+                      args.from_cron)
+            continue
+        disks.append(job.disk)
     return disks
 
 
-def add_disk_metrics(args, metrics):
+def add_cpu_metrics(args, metrics, state):
+    cpu_data = CpuData(state)
+    cpus = []
+    if args.cpu:
+        cpus.append('cpu')
+    if args.cpu_percore:
+        cpus.extend(cpu_data.percpu())
+
+    for cpu in cpus:
+        extra_dims = {'CPU': cpu} if cpu != 'cpu' else None
+        util = cpu_data.cpus[cpu]
+        metrics.add_metric('CpuUser', 'Percent', util['user'],
+                           extra_dims=extra_dims)
+        metrics.add_metric('CpuSystem', 'Percent', util['system'],
+                           extra_dims=extra_dims)
+        metrics.add_metric('CpuIOWait', 'Percent', util['iowait'],
+                           extra_dims=extra_dims)
+        metrics.add_metric('CpuSteal', 'Percent', util['steal'],
+                           extra_dims=extra_dims)
+        metrics.add_metric('CpuIdle', 'Percent', util['idle'],
+                           extra_dims=extra_dims)
+
+
+def add_net_metrics(args, metrics, state):
+    if args.net_interface:
+        include = compile_patterns(args.net_interface)
+    else:
+        include = None
+    exclude = compile_patterns(args.net_interface_exclude or ['lo'])
+
+    net = NetData(state)
+    for interface in sorted(net.interfaces):
+        if (include and not include.match(interface)) or \
+                (not include and exclude.match(interface)):
+            continue
+
+        bytes_in, packets_in, errors_in, drops_in, bytes_out, packets_out, \
+            errors_out, drops_out = net.interfaces[interface]
+        extra_dims = {'Interface': interface}
+        metrics.add_metric('NetworkIn', 'Bytes/Second', bytes_in,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkOut', 'Bytes/Second', bytes_out,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkPacketsIn', 'Count/Second', packets_in,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkPacketsOut', 'Count/Second', packets_out,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkErrorsIn', 'Count/Second', errors_in,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkErrorsOut', 'Count/Second', errors_out,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkDropsIn', 'Count/Second', drops_in,
+                           extra_dims=extra_dims)
+        metrics.add_metric('NetworkDropsOut', 'Count/Second', drops_out,
+                           extra_dims=extra_dims)
+
+    metrics.add_metric('TCPRetransmits', 'Count/Second', net.tcp_retransmits)
+    metrics.add_metric('TCPRetransmitRatio', 'Percent',
+                       net.tcp_retransmit_ratio)
+
+
+def get_disk_info(args, deadline=None):
+    mounts = read_mounts()
+    jobs = []
+    for path in args.disk_path:
+        if path == 'auto':
+            for mount in discover_mounts(args, mounts):
+                jobs.append(DiskStatJob(mount.mount_point, mount, True))
+            continue
+
+        mount = find_mount(path, mounts)
+        if not mount:
+            raise ValueError('Disk file path ' + path +
+                             ' does not exist or cannot be accessed.')
+        jobs.append(DiskStatJob(path, mount))
+    return stat_disks(args, jobs, deadline)
+
+
+def add_disk_io_metrics(metrics, disks, state):
+    disk_io = DiskIO(state)
+    for disk in disks:
+        # filesystems without a block device (e.g. NFS, tmpfs) are skipped
+        io = disk_io.devices.get(disk.device)
+        if not io:
+            continue
+        metrics.add_metric('DiskReadOps', 'Count/Second', io['read_ops'],
+                           disk.mount, disk.file_system)
+        metrics.add_metric('DiskWriteOps', 'Count/Second', io['write_ops'],
+                           disk.mount, disk.file_system)
+        metrics.add_metric('DiskReadBytes', 'Bytes/Second', io['read_bytes'],
+                           disk.mount, disk.file_system)
+        metrics.add_metric('DiskWriteBytes', 'Bytes/Second',
+                           io['write_bytes'], disk.mount, disk.file_system)
+        metrics.add_metric('DiskReadLatency', 'Milliseconds',
+                           io['read_latency'], disk.mount, disk.file_system)
+        metrics.add_metric('DiskWriteLatency', 'Milliseconds',
+                           io['write_latency'], disk.mount, disk.file_system)
+        metrics.add_metric('DiskQueueLength', 'Count', io['queue_length'],
+                           disk.mount, disk.file_system)
+
+
+def add_disk_metrics(args, metrics, state, deadline=None):
     disk_unit_name = SIZE_UNITS_CFG[args.disk_space_units]['name']
     disk_unit_div = float(SIZE_UNITS_CFG[args.disk_space_units]['div'])
-    disks = get_disk_info(args)
+    disks = get_disk_info(args, deadline)
+    if args.disk_io:
+        add_disk_io_metrics(metrics, disks, state)
     for disk in disks:
         if args.disk_space_util:
             metrics.add_metric('DiskSpaceUtilization', 'Percent',
@@ -437,37 +1138,206 @@ def add_disk_metrics(args, metrics):
                                disk.inode_util, disk.mount, disk.file_system)
 
 
-def add_process_metrics(args, metrics):
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read().decode('utf-8', 'replace')
+
+
+def read_processes(read_cmdline):
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            stat = read_file('/proc/' + pid + '/stat')
+            cmdline = None
+            if read_cmdline:
+                cmdline = read_file('/proc/' + pid + '/cmdline') \
+                    .replace('\0', ' ').strip()
+        except (IOError, OSError):
+            # process exited meanwhile
+            continue
+
+        # the command name may contain spaces and parentheses
+        comm_end = stat.rfind(')')
+        comm = stat[stat.find('(') + 1:comm_end]
+        fields = stat[comm_end + 2:].split()
+        yield Process(int(pid), comm, cmdline or comm,
+                      int(fields[11]) + int(fields[12]),
+                      int(fields[19]), int(fields[21]))
+
+
+def read_uptime():
+    with open('/proc/uptime') as f:
+        return float(f.read().split()[0])
+
+
+def counter_deltas(state, key, counters):
+    # Returns the deltas of the counters to their previous sample and the
+    # seconds elapsed since then. Counters without previous sample (first
+    # run, reboot, counter reset) are returned as counted since boot.
+    uptime = read_uptime()
+    previous = state.swap(key, {'uptime': uptime, 'counters': counters})
+    if previous and previous['uptime'] >= uptime:
+        # rebooted since the previous sample
+        previous = None
+
+    deltas = {}
+    for name, values in counters.items():
+        prev_values = previous and previous['counters'].get(name)
+        if prev_values and all(v >= p for v, p in zip(values, prev_values)):
+            deltas[name] = ([v - p for v, p in zip(values, prev_values)],
+                            uptime - previous['uptime'])
+        else:
+            deltas[name] = (values, uptime)
+    return deltas
+
+
+def add_process_metrics(args, metrics, state):
     process_names = args.process_name
-    for process_name in process_names:
-        processes = subprocess.Popen(["ps", "axco", "command,pcpu,pmem"], stdout=subprocess.PIPE)
-        total_cnt = 0
-        total_cpu = 0.0
-        total_mem = 0.0
-        for line in processes.stdout:
-            if re.search(process_name, line):
-                total_cnt += 1
-                out = line.split()
-                total_cpu += float(out[1])
-                total_mem += float(out[2])
-        metrics.add_metric(process_name+'-Count', 'Count', total_cnt)
-        metrics.add_metric(process_name+'-CpuUtilization', 'Percent', total_cpu)
-        metrics.add_metric(process_name+'-MemoryUtilization', 'Percent', total_mem)
-
-
-def add_static_file_metrics(args, metrics):
-    with open(args.from_file[0]) as f:
-        for line in f.readlines():
-            try:
-                (label, unit, value) = [x.strip() for x in line.split(',')]
-                metrics.add_metric(label, unit, value)
-            except ValueError:
-                print('Ignore unparseable metric: "' + line + '"')
-                pass
+    patterns = [re.compile(name) for name in process_names]
+    try:
+        # cheap rejection of processes that don't match any pattern
+        any_pattern = re.compile('|'.join('(?:' + name + ')'
+                                          for name in process_names))
+    except re.error:
+        any_pattern = None
+
+    clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    mem_total = MemData(False).mem_total
+    uptime = read_uptime()
+
+    live = set()
+    total_cnt = [0] * len(patterns)
+    total_cpu = [0.0] * len(patterns)
+    total_mem = [0.0] * len(patterns)
+    for process in read_processes(args.process_match_cmdline):
+        # pid and start time identify a process even if pids are reused
+        key = 'process:{0}:{1}'.format(process.pid, process.start_ticks)
+        live.add(key)
+
+        name = process.cmdline if args.process_match_cmdline else process.comm
+        if any_pattern and not any_pattern.search(name):
+            continue
+
+        # one sample per process, so jobs watching other processes don't
+        # replace it
+        previous = state.swap(key, [uptime, process.cpu_ticks])
+        ticks = process.cpu_ticks
+        since = process.start_ticks / clock_ticks
+        if previous and previous[0] < uptime:
+            ticks -= previous[1]
+            since = previous[0]
+
+        # falls back to the lifetime average (like ps) without previous sample
+        elapsed = uptime - since
+        cpu = 0.0
+        if elapsed > 0:
+            cpu = 100.0 * ticks / clock_ticks / elapsed
+        mem = 100.0 * process.rss * page_size / mem_total
+
+        for idx, pattern in enumerate(patterns):
+            if pattern.search(name):
+                total_cnt[idx] += 1
+                total_cpu[idx] += cpu
+                total_mem[idx] += mem
+
+    # samples of exited processes, whichever job stored them
+    for key in state.keys():
+        if key.startswith('process:') and key not in live:
+            state.delete(key)
+
+    for idx, process_name in enumerate(process_names):
+        metrics.add_metric(process_name+'-Count', 'Count', total_cnt[idx])
+        metrics.add_metric(process_name+'-CpuUtilization', 'Percent', total_cpu[idx])
+        metrics.add_metric(process_name+'-MemoryUtilization', 'Percent', total_mem[idx])
+
+
+# CloudWatch rejects a whole request with a timestamp out of this range
+MAX_TIMESTAMP_AGE = datetime.timedelta(days=14)
+MAX_TIMESTAMP_AHEAD = datetime.timedelta(hours=2)
+
+
+def parse_timestamp(s):
+    try:
+        return datetime.datetime.utcfromtimestamp(float(s))
+    except (ValueError, OverflowError, OSError):
+        pass
+    for fmt in '%Y-%m-%dT%H:%M:%SZ', TIMESTAMP_FORMAT:
+        try:
+            return datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp: ' + s)
+
+
+def parse_static_file_row(row):
+    # name,unit,value[,timestamp][,dimension=value...]
+    fields = [x.strip() for x in row]
+    if len(fields) < 3 or not fields[0]:
+        raise ValueError('Expected name,unit,value')
+
+    value = float(fields[2])
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError('Invalid value: ' + fields[2])
+
+    timestamp = None
+    dims = {}
+    for idx, field in enumerate(fields[3:]):
+        name, sep, dim_value = field.partition('=')
+        if sep and name and dim_value:
+            dims[name] = dim_value
+        elif idx == 0 and not sep:
+            timestamp = parse_timestamp(field)
+            now = datetime.datetime.utcnow()
+            if not now - MAX_TIMESTAMP_AGE <= timestamp <= \
+                    now + MAX_TIMESTAMP_AHEAD:
+                raise ValueError('Timestamp out of range: ' + field)
+        else:
+            raise ValueError('Invalid dimension: ' + field)
+
+    return fields[0], fields[1] or None, value, timestamp, dims
+
+
+def print_datums(datums):
+    for datum in datums:
+        print('{0}: {1} {2} ({3}) {4}'.format(
+            datum.name, datum.values[0], datum.unit, datum.dimensions,
+            datum.timestamp.strftime(TIMESTAMP_FORMAT)))
+        yield datum
+    print()
+
+
+def read_static_file_metrics(args, new_metrics, timestamp):
+    # Yields the metric data of all files row by row as they are read, so
+    # files of any size, stdin and named pipes work with constant memory
+    for filename in args.from_file:
+        f = sys.stdin if filename == '-' else open(filename)
+        try:
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                try:
+                    name, unit, value, row_timestamp, dims = \
+                        parse_static_file_row(row)
+                    metrics = new_metrics()
+                    metrics.add_metric(name, unit, value, extra_dims=dims)
+                    datums = metrics.datums(row_timestamp or timestamp)
+                except ValueError:
+                    print('Ignore unparseable metric: "' + ','.join(row) +
+                          '"')
+                    continue
+                for datum in datums:
+                    yield datum
+        finally:
+            if f is not sys.stdin:
+                f.close()
 
 
 @FileCache
 def get_autoscaling_group_name(region, instance_id, verbose):
+    import boto.ec2.autoscale
+
     boto_debug = 2 if verbose else 0
 
     # TODO add timeout
@@ -490,29 +1360,262 @@ def validate_args(args):
     report_disk_data = args.disk_path is not None
     report_loadavg_data = args.loadavg or args.loadavg_percpu
     report_process_data = args.process_name is not None
+    report_cpu_data = args.cpu or args.cpu_percore
+    report_net_data = args.net
 
     if report_disk_data:
         if not args.disk_space_util and not args.disk_space_used and \
-                not args.disk_space_avail and not args.disk_inode_util:
+                not args.disk_space_avail and not args.disk_inode_util and \
+                not args.disk_io:
             raise ValueError('Disk path is provided but metrics to report '
                              'disk space are not specified.')
 
-        for path in args.disk_path:
-            if not os.path.isdir(path):
-                raise ValueError('Disk file path ' + path +
-                                 ' does not exist or cannot be accessed.')
+        if (args.fs_type_include or args.mount_exclude) and \
+                'auto' not in args.disk_path:
+            raise ValueError('Filesystem type and mount filters require '
+                             '--disk-path=auto.')
     elif args.disk_space_util or args.disk_space_used or \
-            args.disk_space_avail or args.disk_inode_util:
+            args.disk_space_avail or args.disk_inode_util or args.disk_io:
         raise ValueError('Metrics to report disk space are provided but '
                          'disk path is not specified.')
 
+    if args.interval < 1:
+        raise ValueError('Interval must be at least one second.')
+
+    if args.heartbeat < 1:
+        raise ValueError('Heartbeat must be at least one second.')
+
+    if args.connections < 1 or args.max_retries < 0:
+        raise ValueError('Connections must be positive and retries must not '
+                         'be negative.')
+
+    if args.disk_timeout <= 0 or args.disk_workers < 1:
+        raise ValueError('Disk timeout and workers must be positive.')
+
+    if args.collect_timeout < 0:
+        raise ValueError('Collect timeout must not be negative.')
+
+    if args.sample_interval is not None:
+        if not args.daemon:
+            raise ValueError('Sample interval requires daemon mode.')
+        if args.sample_interval < 1 or args.sample_interval > args.interval:
+            raise ValueError('Sample interval must be between one second '
+                             'and the interval.')
+
+    if args.statsd and not args.daemon:
+        raise ValueError('StatsD requires daemon mode.')
+
+    if args.metrics_listen and not args.daemon:
+        raise ValueError('The metrics endpoint requires daemon mode.')
+
+    if args.statsd_percentile is None:
+        args.statsd_percentile = [90.0, 99.0]
+    if any(p <= 0 or p > 100 for p in args.statsd_percentile):
+        raise ValueError('Percentiles must be between 0 and 100.')
+
     if not report_mem_data and not report_disk_data and \
             not args.from_file and not report_loadavg_data and \
-            not report_process_data:
+            not report_process_data and not report_cpu_data and \
+            not report_net_data and not args.statsd:
         raise ValueError('No metrics specified for collection and '
                          'submission to CloudWatch.')
 
-    return report_disk_data, report_mem_data, report_loadavg_data, report_process_data
+    if (args.net_interface or args.net_interface_exclude) and \
+            not report_net_data:
+        raise ValueError('Network interface filters require --net.')
+
+    if args.net_interface and args.net_interface_exclude:
+        raise ValueError('Network interfaces can either be included or '
+                         'excluded.')
+
+    return report_disk_data, report_mem_data, report_loadavg_data, \
+        report_process_data, report_cpu_data, report_net_data
+
+
+class Reporter:
+    def __init__(self, args, reports, metadata, autoscaling_group_name,
+                 awsProfile, emf_stream=None):
+        self.args = args
+        self.reports = reports
+        self.metadata = metadata
+        self.region = metadata['placement']['availability-zone'][:-1]
+        self.autoscaling_group_name = autoscaling_group_name
+        self.awsProfile = awsProfile
+        self.publisher = None
+        self.spool = None
+        if args.spool_max_size > 0 and not args.verify and not args.emf:
+            self.spool = Spool(META_DATA_CACHE_DIR,
+                               int(args.spool_max_size * 1048576))
+        self.state = CounterState(
+            None if args.daemon else
+            os.path.join(META_DATA_CACHE_DIR, CLIENT_NAME + '-state.json'))
+        self.period_metrics = None
+        self.period_end = None
+        self.statsd = None
+        self.exposition = None
+        self.emf = EmfWriter(args.emf, emf_stream) if args.emf else None
+
+    def new_metrics(self):
+        return Metrics(self.region,
+                       self.metadata['instance-id'],
+                       self.metadata['instance-type'],
+                       self.metadata['ami-id'],
+                       self.args.aggregated,
+                       self.autoscaling_group_name)
+
+    def collect(self, metrics):
+        report_disk_data, report_mem_data, report_loadavg_data, \
+            report_process_data, report_cpu_data, report_net_data = \
+            self.reports
+
+        deadline = None
+        if self.args.collect_timeout:
+            deadline = time.time() + self.args.collect_timeout
+
+        collectors = []
+        if report_mem_data:
+            collectors.append(add_memory_metrics)
+        if report_loadavg_data:
+            collectors.append(add_loadavg_metrics)
+        if report_cpu_data:
+            collectors.append(lambda args, metrics:
+                              add_cpu_metrics(args, metrics, self.state))
+        if report_net_data:
+            collectors.append(lambda args, metrics:
+                              add_net_metrics(args, metrics, self.state))
+        if report_disk_data:
+            collectors.append(lambda args, metrics:
+                              add_disk_metrics(args, metrics, self.state,
+                                               deadline))
+        if report_process_data:
+            collectors.append(lambda args, metrics:
+                              add_process_metrics(args, metrics, self.state))
+
+        for collector in collectors:
+            if deadline is not None and time.time() >= deadline:
+                log_error('Collect timeout exceeded, remaining metrics '
+                          'skipped.', self.args.from_cron)
+                break
+            collector(self.args, metrics)
+
+        self.state.save()
+
+        if self.exposition:
+            self.exposition.update(metrics)
+
+    def report(self):
+        metrics = self.new_metrics()
+        self.collect(metrics)
+        self.publish(metrics)
+
+    def sample(self):
+        now = time.time()
+        if self.period_metrics is None:
+            self.period_metrics = self.new_metrics()
+            self.period_end = now + self.args.interval
+        elif now >= self.period_end:
+            metrics = self.period_metrics
+            self.period_metrics = self.new_metrics()
+            while self.period_end <= now:
+                self.period_end += self.args.interval
+
+            self.publish(metrics)
+
+        samples = self.new_metrics()
+        self.collect(samples)
+        self.period_metrics.add_samples(samples)
+
+    def record_deadband(self, sent):
+        # only values that were actually sent suppress the next ones
+        if sent:
+            for key, value in sent.items():
+                self.state.put(key, value)
+            self.state.save()
+
+    def publish(self, metrics):
+        args = self.args
+
+        if self.statsd:
+            invalid = self.statsd.flush(metrics)
+            if invalid:
+                log_error('Ignored {0} invalid StatsD lines.'.format(invalid),
+                          args.from_cron)
+
+        sent = None
+        if args.deadband:
+            sent = metrics.apply_deadband(args.deadband, args.heartbeat,
+                                          self.state)
+
+        file_datums = None
+        if args.from_file:
+            file_datums = read_static_file_metrics(
+                args, self.new_metrics, datetime.datetime.utcnow())
+
+        if args.verbose:
+            print('Request:\n' + str(metrics), end='')
+            if file_datums:
+                file_datums = print_datums(file_datums)
+            else:
+                print()
+
+        if args.verify:
+            if file_datums:
+                for _ in file_datums:
+                    pass
+            if not args.from_cron:
+                print('Verification completed successfully. '
+                      'No actual metrics sent to CloudWatch.')
+            return
+
+        if self.emf:
+            datums = metrics.datums(datetime.datetime.utcnow())
+            if file_datums:
+                datums = itertools.chain(datums, file_datums)
+            rejected = self.emf.write(datums)
+            self.record_deadband(sent)
+            if rejected:
+                log_error('Skipped metrics named like one of their '
+                          'dimensions: ' +
+                          ', '.join(sorted(set(d.name for d in rejected))),
+                          args.from_cron)
+            if not args.from_cron and args.emf != '-':
+                print('Successfully wrote metrics to ' + args.emf + '.')
+            return
+
+        if not self.publisher:
+            from cloudwatchmon.publisher import Publisher
+
+            self.publisher = Publisher(self.region, self.awsProfile,
+                                       args.endpoint_url, args.connections,
+                                       args.connect_timeout,
+                                       args.read_timeout, args.max_retries,
+                                       args.compress, args.verbose)
+        metrics.send(args.verbose, self.awsProfile, self.publisher,
+                     self.spool, file_datums)
+        self.record_deadband(sent)
+
+        if not args.from_cron:
+            print('Successfully reported metrics to CloudWatch.')
+
+
+def stop_daemon(signum, frame):
+    raise SystemExit(0)
+
+
+def run_daemon(interval, tick):
+    signal.signal(signal.SIGTERM, stop_daemon)
+
+    next_run = time.time()
+    while True:
+        tick()
+
+        # stay on schedule - skip the slots a long running tick overlapped
+        next_run += interval
+        now = time.time()
+        if next_run <= now:
+            next_run += ((now - next_run) // interval + 1) * interval
+
+        time.sleep(next_run - now)
 
 
 def main():
@@ -524,20 +1627,28 @@ def main():
         return 1
 
     args = parser.parse_args()
+    FileCache.USE_SYSLOG = args.from_cron
 
     if args.version:
         print(CLIENT_NAME + ' version ' + VERSION)
         return 0
 
     try:
-        report_disk_data, report_mem_data, report_loadavg_data, report_process_data = \
-            validate_args(args)
+        reports = validate_args(args)
+
+        emf_stream = None
+        if args.emf == '-':
+            # stdout carries the EMF records only, any other output goes to
+            # stderr
+            emf_stream, sys.stdout = sys.stdout, sys.stderr
 
         # avoid a storm of calls at the beginning of a minute
         if args.from_cron:
             time.sleep(random.randint(0, 19))
 
         if args.verbose:
+            import boto
+
             print('Working in verbose mode')
             print('Boto-Version: ' + boto.__version__)
 
@@ -557,44 +1668,41 @@ def main():
             if args.verbose:
                 print('Autoscaling group: ' + autoscaling_group_name)
 
-        metrics = Metrics(region,
-                          instance_id,
-                          metadata['instance-type'],
-                          metadata['ami-id'],
-                          args.aggregated,
-                          autoscaling_group_name)
+        # Check for AWS profile
+        awsProfile = None
+        if args.aws_profile_name:
+            awsProfile = args.aws_profile_name
 
-        if args.from_file:
-            add_static_file_metrics(args, metrics)
+        reporter = Reporter(args, reports, metadata, autoscaling_group_name,
+                            awsProfile, emf_stream)
 
-        if report_mem_data:
-            add_memory_metrics(args, metrics)
+        if not args.daemon:
+            reporter.report()
+            return 0
 
-        if report_loadavg_data:
-            add_loadavg_metrics(args, metrics)
+        if args.metrics_listen:
+            from cloudwatchmon.openmetrics import Exposition
 
-        if report_disk_data:
-            add_disk_metrics(args, metrics)
+            reporter.exposition = Exposition(args.metrics_listen)
 
-        if report_process_data:
-            add_process_metrics(args, metrics)
+        if args.statsd:
+            reporter.statsd = StatsdAggregator(args.statsd_percentile)
+            StatsdListener(args.statsd, reporter.statsd).start()
 
-        if args.verbose:
-            print('Request:\n' + str(metrics))
+        if args.sample_interval:
+            interval, tick = args.sample_interval, reporter.sample
+        else:
+            interval, tick = args.interval, reporter.report
 
-        # Check for AWS profile
-        awsProfile = None
-        if args.aws_profile_name:
-            awsProfile = args.aws_profile_name
+        def daemon_tick():
+            try:
+                tick()
+            except Exception as e:
+                log_error(str(e), args.from_cron)
 
-        if args.verify:
-            if not args.from_cron:
-                print('Verification completed successfully. '
-                      'No actual metrics sent to CloudWatch.')
-        else:
-            metrics.send(args.verbose, awsProfile)
-            if not args.from_cron:
-                print('Successfully reported metrics to CloudWatch.')
+        run_daemon(interval, daemon_tick)
+    except KeyboardInterrupt:
+        return 0
     except Exception as e:
         log_error(str(e), args.from_cron)
         return 1
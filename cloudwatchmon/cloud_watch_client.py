@@ -16,51 +16,179 @@
 # limitations under the License.
 
 from __future__ import print_function
-import boto
-import boto.utils
+import fcntl
 import hashlib
+import json
 import os
-import pkg_resources
-import pickle
 import sys
 import syslog
+import threading
 import time
 from cloudwatchmon import VERSION
 
-pkg_resources.require('boto>=2.33.0')
-
 META_DATA_CACHE_DIR = os.environ.get('AWS_EC2CW_META_DATA', '/tmp/aws-mon')
-META_DATA_CACHE_TTL = os.environ.get('AWS_EC2CW_META_DATA_TTL', 21600)
+META_DATA_CACHE_TTL = int(os.environ.get('AWS_EC2CW_META_DATA_TTL', 21600))
+
+
+def atomic_write(filename, data, sync=False):
+    # Replaces the file with data (str or bytes) by renaming a temporary
+    # file, readers see either the old or the new content
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        os.chmod(tmp, 0o600)
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(tmp, filename)
 
 
+# Caches the results of a function in memory and as JSON files for
+# META_DATA_CACHE_TTL seconds. Processes missing the same result wait for
+# the one fetching it. Expired results are still returned while they are
+# refreshed in the background, so a failing metadata or Auto Scaling
+# request doesn't fail the run.
 class FileCache:
     CLIENT_NAME = None
+    USE_SYSLOG = False
 
     def __init__(self, fnc):
         self.fnc = fnc
+        self.memory = {}
         if not os.path.exists(META_DATA_CACHE_DIR):
             os.makedirs(META_DATA_CACHE_DIR)
 
+    @staticmethod
+    def __read(filename):
+        # returns modification time and value
+        try:
+            with open(filename) as f:
+                return os.fstat(f.fileno()).st_mtime, json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def __refresh(self, sig, filename, args, kwargs):
+        value = self.fnc(*args, **kwargs)
+        atomic_write(filename, json.dumps(value))
+        self.memory[sig] = (time.time(), value)
+        return value
+
+    def __revalidate(self, lock, sig, filename, args, kwargs):
+        try:
+            self.__refresh(sig, filename, args, kwargs)
+        except Exception as e:
+            # the stale result is used until a refresh succeeds
+            log_error('Could not refresh cached {0}: {1}'
+                      .format(self.fnc.__name__, e), self.USE_SYSLOG)
+        finally:
+            lock.close()
+
     def __call__(self, *args, **kwargs):
         sig = ":".join([VERSION, str(self.fnc.__name__), str(args), str(kwargs)])
 
+        entry = self.memory.get(sig)
+        if entry and entry[0] + META_DATA_CACHE_TTL > time.time():
+            return entry[1]
+
         sig_hash = hashlib.md5(sig.encode('utf-8')).hexdigest()
-        filename = os.path.join(META_DATA_CACHE_DIR, '{0}-{1}.bin'
+        filename = os.path.join(META_DATA_CACHE_DIR, '{0}-{1}.json'
                                 .format(self.CLIENT_NAME, sig_hash))
 
-        if os.path.exists(filename):
-            mtime = os.path.getmtime(filename)
-            now = time.time()
-            if mtime + META_DATA_CACHE_TTL > now:
-                with open(filename, 'rb') as f:
-                    return pickle.load(f)
+        entry = self.__read(filename)
+        if entry and entry[0] + META_DATA_CACHE_TTL > time.time():
+            self.memory[sig] = entry
+            return entry[1]
+
+        lock = open(filename + '.lock', 'a')
+        if entry is None:
+            try:
+                # nothing to return - wait for a concurrent refresh
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entry = self.__read(filename)
+                if entry and entry[0] + META_DATA_CACHE_TTL > time.time():
+                    self.memory[sig] = entry
+                    return entry[1]
+                return self.__refresh(sig, filename, args, kwargs)
+            finally:
+                lock.close()
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            # refreshed by another process
+            lock.close()
+        else:
+            # not a daemon thread, the process waits for the refresh to be
+            # written before it exits
+            threading.Thread(target=self.__revalidate,
+                             args=(lock, sig, filename, args, kwargs)).start()
+        return entry[1]
+
 
-        tmp = self.fnc(*args, **kwargs)
-        with open(filename, 'wb') as f:
-            os.chmod(filename, 0o600)
-            pickle.dump(tmp, f)
+# Previous counter samples to calculate rates from - kept in memory only
+# (daemon mode) or persisted between runs if a filename is given
+class CounterState:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.samples = None
+        self.changed = set()
 
-        return tmp
+    def __read(self):
+        if self.filename and os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    return json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+        return {}
+
+    def get(self, key):
+        if self.samples is None:
+            self.samples = self.__read()
+        return self.samples.get(key)
+
+    def put(self, key, sample):
+        if self.samples is None:
+            self.samples = self.__read()
+        self.samples[key] = sample
+        self.changed.add(key)
+
+    def delete(self, key):
+        if self.samples is None:
+            self.samples = self.__read()
+        if self.samples.pop(key, None) is not None:
+            self.changed.add(key)
+
+    def keys(self):
+        if self.samples is None:
+            self.samples = self.__read()
+        return list(self.samples)
+
+    def swap(self, key, sample):
+        previous = self.get(key)
+        self.put(key, sample)
+        return previous
+
+    def save(self):
+        if not self.filename or not self.changed:
+            return
+
+        # cron jobs with different metrics share the file - only the keys
+        # changed (or deleted) by this process are replaced
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            samples = self.__read()
+            for key in self.changed:
+                if key in self.samples:
+                    samples[key] = self.samples[key]
+                else:
+                    samples.pop(key, None)
+            atomic_write(self.filename, json.dumps(samples))
+
+        self.samples = samples
+        self.changed = set()
 
 
 def log_error(message, use_syslog):
@@ -72,7 +200,9 @@ def log_error(message, use_syslog):
 
 @FileCache
 def get_metadata():
-    metadata = boto.utils.get_instance_metadata(timeout=1, num_retries=2)
-    if not metadata:
-        raise ValueError('Cannot obtain EC2 metadata.')
-    return metadata
+    from cloudwatchmon.metadata import get_client, METADATA_KEYS
+
+    try:
+        return get_client().get_all(METADATA_KEYS)
+    except (IOError, OSError) as e:
+        raise ValueError('Cannot obtain EC2 metadata: {0}'.format(e))
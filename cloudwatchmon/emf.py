@@ -0,0 +1,194 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import json
+import socket
+import sys
+from cloudwatchmon.put_metric_data import NAMESPACE
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# Embedded Metric Format limits
+EMF_LIMIT_METRICS_SIZE = 100
+EMF_LIMIT_VALUES_SIZE = 100
+
+# records kept open for more metrics of the same timestamp and dimensions
+MAX_OPEN_RECORDS = 1000
+
+
+def to_millis(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) * 1000 + \
+        timestamp.microsecond // 1000
+
+
+def emf_value(datum):
+    if datum.statistics:
+        # EMF has no statistic sets
+        return datum.statistics.average()
+    return datum.values[0]
+
+
+def merge_dimension_sets(datums):
+    # Yields (datum, value, dimensions, dimension sets) - consecutive data
+    # of the same metric, timestamp and value that only differ in their
+    # dimensions (the copies of --aggregated and --auto-scaling) are merged
+    # into one with several dimension sets
+    current = None
+    for datum in datums:
+        value = emf_value(datum)
+        dimension_set = tuple(sorted(datum.dimensions))
+        if current is not None:
+            first, first_value, dimensions, dimension_sets = current
+            if datum.name == first.name and datum.unit == first.unit and \
+                    datum.timestamp == first.timestamp and \
+                    value == first_value and \
+                    dimension_set not in dimension_sets and \
+                    all(dimensions.get(k, v) == v
+                        for k, v in datum.dimensions.items()):
+                dimensions.update(datum.dimensions)
+                dimension_sets.append(dimension_set)
+                continue
+            yield current
+        current = (datum, value, dict(datum.dimensions), [dimension_set])
+
+    if current is not None:
+        yield current
+
+
+class Record:
+    def __init__(self, namespace, timestamp, dimensions, dimension_sets):
+        self.namespace = namespace
+        self.timestamp = timestamp
+        self.dimensions = dimensions
+        self.dimension_sets = dimension_sets
+        self.metrics = []
+        self.values = {}
+
+    def add(self, datum, value):
+        # Returns False if the record can't take the datum
+        values = self.values.get(datum.name)
+        if values is None:
+            if len(self.metrics) >= EMF_LIMIT_METRICS_SIZE:
+                return False
+            metric = {'Name': datum.name}
+            if datum.unit:
+                metric['Unit'] = datum.unit
+            self.metrics.append(metric)
+            self.values[datum.name] = [value]
+        elif len(values) >= EMF_LIMIT_VALUES_SIZE:
+            return False
+        else:
+            values.append(value)
+        return True
+
+    def to_json(self):
+        data = dict(self.dimensions)
+        for name, values in self.values.items():
+            data[name] = values[0] if len(values) == 1 else values
+        data['_aws'] = {
+            'Timestamp': to_millis(self.timestamp),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [list(s) for s in self.dimension_sets],
+                'Metrics': self.metrics
+            }]
+        }
+        return json.dumps(data, separators=(',', ':'))
+
+
+def to_records(datums, rejected, namespace=NAMESPACE):
+    # Groups metric data of the same timestamp and dimension sets into
+    # records, yields the records as they are complete. Metric data named
+    # like one of their dimensions are appended to rejected - a record
+    # can't hold both.
+    records = {}
+    for datum, value, dimensions, dimension_sets in \
+            merge_dimension_sets(datums):
+        if datum.name in dimensions:
+            rejected.append(datum)
+            continue
+
+        key = (datum.timestamp, tuple(sorted(dimensions.items())),
+               tuple(dimension_sets))
+        record = records.get(key)
+        if record is not None and not record.add(datum, value):
+            yield records.pop(key)
+            record = None
+        if record is None:
+            if len(records) >= MAX_OPEN_RECORDS:
+                for open_record in records.values():
+                    yield open_record
+                records = {}
+            record = records[key] = Record(namespace, datum.timestamp,
+                                           dimensions, dimension_sets)
+            record.add(datum, value)
+
+    for record in records.values():
+        yield record
+
+
+# Writes metric data as CloudWatch Embedded Metric Format JSON lines to
+# stdout (-), a file or the TCP/UDP listener of the CloudWatch agent
+# (tcp://HOST:PORT or udp://HOST:PORT)
+class EmfWriter:
+    def __init__(self, target, stream=None):
+        self.target = target
+        self.stream = stream or sys.stdout
+        self.url = None
+        if '://' in target:
+            self.url = urlparse(target)
+            if self.url.scheme not in ('tcp', 'udp') or not self.url.port:
+                raise ValueError('Invalid EMF target: ' + target)
+        self.sock = None
+
+    def __connect(self):
+        if self.sock is None:
+            address = (self.url.hostname, self.url.port)
+            if self.url.scheme == 'tcp':
+                self.sock = socket.create_connection(address, 5)
+            else:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.connect(address)
+        return self.sock
+
+    def write(self, datums):
+        # Returns the metric data that can't be written
+        rejected = []
+        lines = (record.to_json() + '\n'
+                 for record in to_records(datums, rejected))
+        if self.target == '-':
+            for line in lines:
+                self.stream.write(line)
+            self.stream.flush()
+        elif self.url is None:
+            with open(self.target, 'a') as f:
+                f.writelines(lines)
+        else:
+            try:
+                sock = self.__connect()
+                for line in lines:
+                    # one datagram per record with UDP
+                    sock.sendall(line.encode('utf-8'))
+            except socket.error:
+                # reconnect with the next write
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                raise
+
+        return rejected
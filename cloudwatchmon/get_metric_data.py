@@ -0,0 +1,163 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import threading
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# GetMetricData limits
+AWS_LIMIT_QUERIES_SIZE = 500
+
+XML_NAMESPACE = '{http://monitoring.amazonaws.com/doc/2010-08-01/}'
+
+QUERY_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class MetricDataQuery:
+    def __init__(self, query_id, params, period):
+        self.id = query_id
+        self.params = params
+        self.period = period
+
+    def member_params(self, prefix):
+        params = {prefix + 'Id': self.id}
+        for k, v in self.params.items():
+            params[prefix + k] = v
+        return params
+
+
+def metric_stat_query(query_id, namespace, metric_name, dimensions, stat,
+                      period):
+    params = {'MetricStat.Metric.Namespace': namespace,
+              'MetricStat.Metric.MetricName': metric_name,
+              'MetricStat.Period': str(period),
+              'MetricStat.Stat': stat}
+    for idx, (name, value) in enumerate(sorted(dimensions.items())):
+        member = 'MetricStat.Metric.Dimensions.member.{0}.'.format(idx + 1)
+        params[member + 'Name'] = name
+        params[member + 'Value'] = value
+    return MetricDataQuery(query_id, params, period)
+
+
+def quote_search_term(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def search_query(query_id, namespace, dimension_names, metric_name,
+                 dimensions, stat, period):
+    # SEARCH expression for metrics with dimensions that are not known
+    # beforehand (e.g. the Filesystem of a mount)
+    schema = ','.join([namespace] + sorted(dimension_names))
+    terms = ['MetricName=' + quote_search_term(metric_name)]
+    for name, value in sorted(dimensions.items()):
+        terms.append('{0}={1}'.format(name, quote_search_term(value)))
+    expression = "SEARCH('{{{0}}} {1}', '{2}', {3})".format(
+        schema, ' '.join(terms).replace("'", "\\'"), stat, period)
+    return MetricDataQuery(query_id, {'Expression': expression}, period)
+
+
+def parse_timestamp(s):
+    return datetime.datetime.strptime(s.split('.')[0].rstrip('Z'),
+                                      '%Y-%m-%dT%H:%M:%S')
+
+
+def find(element, path):
+    return element.find('/'.join(XML_NAMESPACE + p for p in path.split('/')))
+
+
+def findall(element, path):
+    return element.findall('/'.join(XML_NAMESPACE + p
+                                    for p in path.split('/')))
+
+
+def parse_response(data, results):
+    # Adds the data points of a GetMetricData response to results and returns
+    # the NextToken (if any)
+    root = ElementTree.fromstring(data)
+    result = find(root, 'GetMetricDataResult')
+    for member in findall(result, 'MetricDataResults/member'):
+        query_id = find(member, 'Id').text
+        label_element = find(member, 'Label')
+        label = label_element.text if label_element is not None else None
+        timestamps = [parse_timestamp(e.text)
+                      for e in findall(member, 'Timestamps/member')]
+        values = [float(e.text) for e in findall(member, 'Values/member')]
+        results.setdefault(query_id, {}).setdefault(label, []) \
+            .extend(zip(timestamps, values))
+
+    token = find(result, 'NextToken')
+    return token.text if token is not None else None
+
+
+def get_chunk(client, queries, start_time, end_time):
+    params = {'StartTime': start_time.strftime(QUERY_TIMESTAMP_FORMAT),
+              'EndTime': end_time.strftime(QUERY_TIMESTAMP_FORMAT),
+              'ScanBy': 'TimestampAscending'}
+    for idx, query in enumerate(queries):
+        params.update(query.member_params(
+            'MetricDataQueries.member.{0}.'.format(idx + 1)))
+
+    results = {}
+    while True:
+        token = parse_response(client.call('GetMetricData', params), results)
+        if not token:
+            return results
+        params['NextToken'] = token
+
+
+def get_metric_data(client, queries, start_time, end_time):
+    # Returns the data points of all queries as {id: {label: [(timestamp,
+    # value), ...]}} - a SEARCH expression returns one series per label.
+    # Queries are sent in requests of up to 500 queries, one request per
+    # client connection at a time, pages are fetched until there is no
+    # NextToken.
+    todo = queue.Queue()
+    for offset in range(0, len(queries), AWS_LIMIT_QUERIES_SIZE):
+        todo.put(queries[offset:offset + AWS_LIMIT_QUERIES_SIZE])
+    results = {}
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                chunk = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                # a query id is in one chunk only
+                results.update(get_chunk(client, chunk, start_time,
+                                         end_time))
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(client.connections, todo.qsize()))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    for series in results.values():
+        for points in series.values():
+            points.sort()
+    return results
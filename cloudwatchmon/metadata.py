@@ -0,0 +1,183 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import json
+import os
+import socket
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPException
+    from urllib.parse import urlparse
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+    from urlparse import urlparse
+
+# same variable as the AWS SDKs, e.g. to use a local stand-in server
+METADATA_ENDPOINT = os.environ.get('AWS_EC2_METADATA_SERVICE_ENDPOINT',
+                                   'http://169.254.169.254')
+
+# the keys the scripts use
+METADATA_KEYS = ['placement/availability-zone', 'instance-id',
+                 'instance-type', 'ami-id']
+
+TOKEN_TTL = 21600
+
+# tokens and credentials are renewed this many seconds before they expire
+TOKEN_RENEW_BEFORE = 60
+CREDENTIALS_RENEW_BEFORE = 300
+
+
+class MetadataError(IOError):
+    pass
+
+
+# Instance metadata service (IMDSv2) client - requests carry a session
+# token which is reused until it expires
+class MetadataClient:
+    def __init__(self, endpoint=None, timeout=1.0, attempts=2):
+        url = urlparse(endpoint or METADATA_ENDPOINT)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        self.attempts = attempts
+        self.token = None
+        self.token_expires = 0
+        self.lock = threading.Lock()
+
+    def __request(self, method, path, headers):
+        # returns status and body, network errors and 5xx responses are
+        # retried
+        error = None
+        for _ in range(self.attempts):
+            conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                if response.status < 500:
+                    return response.status, body
+                error = MetadataError('{0} {1}: HTTP {2}'.format(
+                    method, path, response.status))
+            except socket.error as e:
+                error = e
+            except HTTPException as e:
+                # not an IOError - callers only handle those
+                error = MetadataError('{0} {1}: {2!r}'.format(method, path,
+                                                              e))
+            finally:
+                conn.close()
+        raise error
+
+    def __get_token(self, rejected=None):
+        with self.lock:
+            if self.token is None or self.token == rejected or \
+                    time.time() >= self.token_expires:
+                status, body = self.__request(
+                    'PUT', '/latest/api/token',
+                    {'X-aws-ec2-metadata-token-ttl-seconds': str(TOKEN_TTL)})
+                if status != 200:
+                    raise MetadataError(
+                        'Cannot obtain EC2 metadata token: HTTP {0}'
+                        .format(status))
+                self.token = body.decode('utf-8')
+                self.token_expires = time.time() + TOKEN_TTL - \
+                    TOKEN_RENEW_BEFORE
+            return self.token
+
+    def get(self, path):
+        token = self.__get_token()
+        status, body = self.__request('GET', '/latest/meta-data/' + path,
+                                      {'X-aws-ec2-metadata-token': token})
+        if status == 401:
+            # token expired early (e.g. the instance was stopped)
+            status, body = self.__request(
+                'GET', '/latest/meta-data/' + path,
+                {'X-aws-ec2-metadata-token': self.__get_token(token)})
+        if status != 200:
+            raise MetadataError('Cannot obtain EC2 metadata {0}: HTTP {1}'
+                                .format(path, status))
+        return body.decode('utf-8')
+
+    def get_all(self, paths):
+        # Fetches the paths in parallel, returns them as nested dict like
+        # boto.utils.get_instance_metadata()
+        self.__get_token()
+        values = {}
+        errors = []
+
+        def fetch(path):
+            try:
+                values[path] = self.get(path)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=(path,))
+                   for path in paths]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
+        metadata = {}
+        for path, value in values.items():
+            parent = metadata
+            parts = path.split('/')
+            for part in parts[:-1]:
+                parent = parent.setdefault(part, {})
+            parent[parts[-1]] = value
+        return metadata
+
+
+# Credentials of the instance profile role, renewed before they expire
+class InstanceProfileCredentials:
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.expires = 0
+        self.get_keys()
+
+    def get_keys(self):
+        # access key, secret key and token of the same credentials
+        with self.lock:
+            if time.time() >= self.expires:
+                self.__refresh()
+            return self.access_key, self.secret_key, self.security_token
+
+    def __refresh(self):
+        role = self.client.get('iam/security-credentials/').split()[0]
+        data = json.loads(self.client.get('iam/security-credentials/' + role))
+        self.access_key = data['AccessKeyId']
+        self.secret_key = data['SecretAccessKey']
+        self.security_token = data['Token']
+        self.expires = calendar.timegm(time.strptime(
+            data['Expiration'], '%Y-%m-%dT%H:%M:%SZ')) - \
+            CREDENTIALS_RENEW_BEFORE
+
+
+default_client = None
+
+
+def get_client():
+    # one client per process to reuse the token
+    global default_client
+    if default_client is None:
+        default_client = MetadataClient()
+    return default_client
@@ -0,0 +1,139 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import datetime
+import hashlib
+import json
+import os
+from cloudwatchmon.cloud_watch_client import atomic_write
+from cloudwatchmon.get_metric_data import get_metric_data
+
+CACHE_SUFFIX = '.json'
+
+
+def to_epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def from_epoch(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+# Data points of GetMetricData queries (metric, dimensions, statistic and
+# period) kept on disk. Periods that ended more than the settle window ago
+# don't change anymore, so only the range after the cached settled periods
+# is fetched again. Least recently used queries are evicted when the cache
+# exceeds max_bytes.
+class MetricDataCache:
+    def __init__(self, directory, max_bytes, settle_window):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle_window = settle_window
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def __filename(self, client, query):
+        # the same query in another region or account endpoint is another
+        # metric
+        key = json.dumps([client.region, client.host,
+                          sorted(query.params.items())])
+        return os.path.join(self.directory,
+                            hashlib.md5(key.encode('utf-8')).hexdigest() +
+                            CACHE_SUFFIX)
+
+    @staticmethod
+    def __load(filename):
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+            # mtime is the last use for eviction
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    @staticmethod
+    def __save(filename, entry):
+        atomic_write(filename, json.dumps(entry, separators=(',', ':')))
+
+    def get_metric_data(self, client, queries, start_time, end_time):
+        # same as get_metric_data() - queries are fetched from the end of
+        # their cached range, queries with the same range are fetched
+        # together
+        start = to_epoch(start_time)
+        settle_end = to_epoch(end_time - self.settle_window)
+        results = {}
+        fetches = {}
+        for query in queries:
+            query_start = start - start % query.period
+            settled = settle_end - settle_end % query.period
+            filename = self.__filename(client, query)
+            entry = self.__load(filename)
+            if entry and entry['start'] <= query_start <= entry['end']:
+                series = results[query.id] = {}
+                for label, points in entry['series']:
+                    series[label] = [(from_epoch(t), v) for t, v in points
+                                     if t >= query_start]
+                fetch_start = entry['end']
+            else:
+                entry = {'start': query_start, 'end': query_start,
+                         'series': []}
+                fetch_start = query_start
+            fetches.setdefault(fetch_start, []).append(
+                (query, filename, entry, settled))
+
+        for fetch_start, group in fetches.items():
+            fetched = get_metric_data(client, [g[0] for g in group],
+                                      from_epoch(fetch_start), end_time)
+            for query, filename, entry, settled in group:
+                series = results.setdefault(query.id, {})
+                cached = dict(entry['series'])
+                for label, points in fetched.get(query.id, {}).items():
+                    series.setdefault(label, []).extend(points)
+                    cached.setdefault(label, []).extend(
+                        [to_epoch(t), v] for t, v in points
+                        if to_epoch(t) < settled)
+
+                if settled > entry['end']:
+                    entry['end'] = settled
+                    entry['series'] = sorted(cached.items(),
+                                             key=lambda s: s[0] or '')
+                    self.__save(filename, entry)
+
+        self.__evict()
+        return results
+
+    def __evict(self):
+        files = []
+        size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+            size += stat.st_size
+
+        files.sort()
+        while files and size > self.max_bytes:
+            _, file_size, filename = files.pop(0)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            size -= file_size
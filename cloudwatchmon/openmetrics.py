@@ -0,0 +1,125 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import socket
+import threading
+from cloudwatchmon.put_metric_data import NAMESPACE, StatisticSet
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# The scraper knows the instance - metrics repeated for these dimensions by
+# --aggregated and --auto-scaling are exposed once
+AGGREGATION_DIMENSIONS = frozenset(['InstanceId', 'InstanceType', 'ImageId',
+                                    'AutoScalingGroupName'])
+
+
+def to_snake_case(name):
+    name = re.sub(r'([A-Z]+)([A-Z][a-z])', r'\1_\2', name)
+    name = re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name)
+    name = re.sub(r'[^a-zA-Z0-9_]+', '_', name).strip('_').lower()
+    return name if not name[:1].isdigit() else '_' + name
+
+
+PREFIX = to_snake_case(NAMESPACE) + '_'
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_metrics(metrics):
+    # One gauge per metric name, statistic sets of sampled metrics are
+    # exposed as their average
+    families = {}
+    seen = set()
+    for i in range(0, len(metrics.names)):
+        labels = tuple(sorted(
+            (to_snake_case(k), v) for k, v in metrics.dimensions[i].items()
+            if k not in AGGREGATION_DIMENSIONS))
+        name = PREFIX + to_snake_case(metrics.names[i])
+        if (name, labels) in seen:
+            continue
+        seen.add((name, labels))
+
+        value = metrics.values[i]
+        if isinstance(value, StatisticSet):
+            value = value.average()
+        families.setdefault(name, []).append((labels, float(value)))
+
+    lines = []
+    for name in sorted(families):
+        lines.append('# TYPE {0} gauge'.format(name))
+        for labels, value in families[name]:
+            label_str = ','.join('{0}="{1}"'.format(k, escape_label_value(v))
+                                 for k, v in labels)
+            lines.append('{0}{1} {2}'.format(
+                name, '{' + label_str + '}' if label_str else '',
+                repr(value)))
+    lines.append('# EOF\n')
+    return '\n'.join(lines)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.exposition.body
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Server6(Server):
+    address_family = socket.AF_INET6
+
+
+# Serves the metrics of the latest collection on http://ADDRESS/metrics in
+# OpenMetrics text format from a background thread
+class Exposition:
+    def __init__(self, address):
+        host, sep, port = address.rpartition(':')
+        if not sep or not port.isdigit():
+            raise ValueError('Invalid metrics address: ' + address)
+        host = host.strip('[]')
+        server_class = Server6 if ':' in host else Server
+
+        self.body = b'# EOF\n'
+        self.server = server_class((host, int(port)), Handler)
+        self.server.exposition = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def update(self, metrics):
+        # replaced as a whole, requests see either the old or new metrics
+        self.body = format_metrics(metrics).encode('utf-8')
@@ -0,0 +1,313 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import re
+
+try:
+    from urllib.parse import quote_plus
+except ImportError:
+    from urllib import quote_plus
+
+NAMESPACE = 'System/Linux'
+
+# PutMetricData limits
+AWS_LIMIT_METRICS_SIZE = 1000
+AWS_LIMIT_REQUEST_BYTES = 1048576
+AWS_LIMIT_VALUES_SIZE = 150
+AWS_LIMIT_DIMENSIONS_SIZE = 30
+
+# room for Action, Version, Namespace and authentication parameters
+REQUEST_OVERHEAD_BYTES = 4096
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# widest member prefix - sizes are calculated with it to be on the safe side
+MEMBER_PREFIX = 'MetricData.member.{0}.'.format(AWS_LIMIT_METRICS_SIZE)
+
+
+class StatisticSet:
+    def __init__(self):
+        self.sample_count = 0
+        self.sum = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        value = float(value)
+        self.sample_count += 1
+        self.sum += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        self.sample_count += other.sample_count
+        self.sum += other.sum
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def average(self):
+        return self.sum / self.sample_count
+
+    def __str__(self):
+        return 'SampleCount={0}, Sum={1}, Minimum={2}, Maximum={3}' \
+            .format(self.sample_count, self.sum, self.minimum, self.maximum)
+
+
+def format_number(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# characters quote_plus leaves alone (or encodes as '+')
+UNQUOTED_RE = re.compile(r'[A-Za-z0-9_.~ -]*\Z')
+
+# there are only a few distinct parameter names
+KEY_SIZES = {}
+
+
+def quoted_size(s):
+    if UNQUOTED_RE.match(s):
+        return len(s)
+    return len(quote_plus(s))
+
+
+def param_size(key, value):
+    # key=value&
+    key_size = KEY_SIZES.get(key)
+    if key_size is None:
+        key_size = KEY_SIZES[key] = quoted_size(key)
+    return key_size + quoted_size(value) + 2
+
+
+# Upper bounds of encoded numbers - sizes are calculated with them so a datum
+# doesn't need to be re-encoded when it is merged
+MAX_NUMBER_LEN = 24
+MAX_COUNT_LEN = 10
+
+# size of one Values and Counts member pair
+VALUE_MEMBER = '{0}Values.member.{1}'.format(MEMBER_PREFIX,
+                                             AWS_LIMIT_VALUES_SIZE)
+VALUE_SIZE = param_size(VALUE_MEMBER, '0' * MAX_NUMBER_LEN) + \
+    param_size(VALUE_MEMBER, '0' * MAX_COUNT_LEN)
+
+
+class MetricDatum:
+    def __init__(self, name, unit, dimensions, timestamp, value):
+        if len(dimensions) > AWS_LIMIT_DIMENSIONS_SIZE:
+            raise ValueError('Metric {0} has more than {1} dimensions'
+                             .format(name, AWS_LIMIT_DIMENSIONS_SIZE))
+
+        self.name = name
+        self.unit = unit
+        self.dimensions = dimensions
+        self.timestamp = timestamp
+        self.statistics = None
+        self.values = []
+        self.counts = []
+        self.value_index = {}
+        if isinstance(value, StatisticSet):
+            self.statistics = value
+        else:
+            self.value_index[float(value)] = 0
+            self.values.append(float(value))
+            self.counts.append(1)
+
+        self.size = 0
+        for k, v in self.__params(with_values=False):
+            self.size += param_size(MEMBER_PREFIX + k, v)
+        if self.statistics:
+            self.size += 4 * param_size(MEMBER_PREFIX +
+                                        'StatisticValues.SampleCount',
+                                        '0' * MAX_NUMBER_LEN)
+        else:
+            self.size += self.value_size(len(self.values))
+
+    def key(self):
+        return (self.name, self.unit, tuple(sorted(self.dimensions.items())),
+                self.timestamp, self.statistics is not None)
+
+    @staticmethod
+    def value_size(count):
+        return count * VALUE_SIZE
+
+    def merge_size(self, other):
+        # Returns the number of bytes the datum grows by merging other into it
+        # - or None if it can't be merged
+        if self.statistics:
+            return 0
+        added = len([v for v in other.values if v not in self.value_index])
+        if len(self.values) + added > AWS_LIMIT_VALUES_SIZE:
+            return None
+        return self.value_size(added)
+
+    def merge(self, other):
+        if self.statistics:
+            self.statistics.merge(other.statistics)
+            return
+
+        for value, count in zip(other.values, other.counts):
+            idx = self.value_index.get(value)
+            if idx is not None:
+                self.counts[idx] += count
+                continue
+
+            self.value_index[value] = len(self.values)
+            self.values.append(value)
+            self.counts.append(count)
+            self.size += self.value_size(1)
+
+    def __params(self, with_values=True):
+        params = [('MetricName', self.name)]
+        if self.unit:
+            params.append(('Unit', self.unit))
+        if self.timestamp:
+            params.append(('Timestamp',
+                           self.timestamp.strftime(TIMESTAMP_FORMAT)))
+
+        for idx, (name, value) in enumerate(sorted(self.dimensions.items())):
+            member = 'Dimensions.member.{0}.'.format(idx + 1)
+            params.append((member + 'Name', name))
+            params.append((member + 'Value', value))
+
+        if not with_values:
+            return params
+
+        if self.statistics:
+            s = self.statistics
+            params.append(('StatisticValues.SampleCount',
+                           format_number(s.sample_count)))
+            params.append(('StatisticValues.Sum', format_number(s.sum)))
+            params.append(('StatisticValues.Minimum',
+                           format_number(s.minimum)))
+            params.append(('StatisticValues.Maximum',
+                           format_number(s.maximum)))
+        elif len(self.values) == 1 and self.counts[0] == 1:
+            params.append(('Value', format_number(self.values[0])))
+        else:
+            for idx in range(0, len(self.values)):
+                member = '.member.{0}'.format(idx + 1)
+                params.append(('Values' + member,
+                               format_number(self.values[idx])))
+                params.append(('Counts' + member,
+                               format_number(self.counts[idx])))
+
+        return params
+
+    def params(self, prefix):
+        return [(prefix + k, v) for k, v in self.__params()]
+
+    def to_dict(self):
+        data = {'name': self.name, 'unit': self.unit,
+                'dimensions': self.dimensions,
+                'timestamp': self.timestamp.strftime(TIMESTAMP_FORMAT)}
+        if self.statistics:
+            s = self.statistics
+            data['statistics'] = [s.sample_count, s.sum, s.minimum,
+                                  s.maximum]
+        else:
+            data['values'] = self.values
+            data['counts'] = self.counts
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        timestamp = datetime.datetime.strptime(data['timestamp'],
+                                               TIMESTAMP_FORMAT)
+        if 'statistics' in data:
+            value = StatisticSet()
+            value.sample_count, value.sum, value.minimum, value.maximum = \
+                data['statistics']
+            return MetricDatum(data['name'], data['unit'], data['dimensions'],
+                               timestamp, value)
+
+        datum = None
+        for value, count in zip(data['values'], data['counts']):
+            other = MetricDatum(data['name'], data['unit'],
+                                data['dimensions'], timestamp, value)
+            other.counts[0] = count
+            if datum:
+                datum.merge(other)
+            else:
+                datum = other
+        return datum
+
+
+class Batch:
+    def __init__(self):
+        self.datums = []
+        self.size = REQUEST_OVERHEAD_BYTES
+
+    def params(self, namespace=NAMESPACE):
+        params = {'Namespace': namespace}
+        for idx, datum in enumerate(self.datums):
+            params.update(datum.params('MetricData.member.{0}.'
+                                       .format(idx + 1)))
+        return params
+
+    def __len__(self):
+        return len(self.datums)
+
+
+# Packs metric data into as few PutMetricData requests as possible. Values of
+# the same metric (name, unit, dimensions and timestamp) are merged into the
+# Values and Counts arrays (statistic sets are combined).
+class BatchPacker:
+    def __init__(self, max_metrics=AWS_LIMIT_METRICS_SIZE,
+                 max_bytes=AWS_LIMIT_REQUEST_BYTES):
+        self.max_metrics = max_metrics
+        self.max_bytes = max_bytes
+        self.batch = Batch()
+        self.index = {}
+
+    def add(self, datum):
+        # Returns the batches completed by adding datum
+        key = datum.key()
+        existing = self.index.get(key)
+        if existing:
+            grow = existing.merge_size(datum)
+            if grow is not None and self.batch.size + grow <= self.max_bytes:
+                existing.merge(datum)
+                self.batch.size += grow
+                return []
+
+        completed = []
+        if len(self.batch) >= self.max_metrics or \
+                self.batch.size + datum.size > self.max_bytes:
+            completed = self.flush()
+
+        self.batch.datums.append(datum)
+        self.batch.size += datum.size
+        self.index[key] = datum
+        return completed
+
+    def flush(self):
+        if not self.batch.datums:
+            return []
+        batch = self.batch
+        self.batch = Batch()
+        self.index = {}
+        return [batch]
+
+
+def pack(datums):
+    packer = BatchPacker()
+    batches = []
+    for datum in datums:
+        batches.extend(packer.add(datum))
+    batches.extend(packer.flush())
+    return batches
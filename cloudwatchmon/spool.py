@@ -0,0 +1,148 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import errno
+import fcntl
+import json
+import os
+from cloudwatchmon.cloud_watch_client import atomic_write
+from cloudwatchmon.put_metric_data import MetricDatum
+
+SPOOL_FILENAME = 'spool.jsonl'
+REPLAY_PREFIX = SPOOL_FILENAME + '.replay-'
+
+# CloudWatch rejects metric data older than two weeks
+MAX_AGE = datetime.timedelta(days=14)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+# Append-only file of metric data that could not be sent. Every line holds the
+# metric data of one failed request with its original timestamps. A run takes
+# the spool over by renaming it and deletes it after everything is sent or
+# spooled again, so a crash in between loses nothing.
+class Spool:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.filename = os.path.join(directory, SPOOL_FILENAME)
+        self.max_bytes = max_bytes
+        self.taken = []
+        self.replays = 0
+
+    def __lock(self):
+        fd = os.open(self.filename + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def __unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def append(self, batches):
+        if not batches:
+            return
+
+        data = ''.join(json.dumps([d.to_dict() for d in batch.datums]) + '\n'
+                       for batch in batches).encode('utf-8')
+
+        lock = self.__lock()
+        try:
+            # one write and one fsync for all batches
+            fd = os.open(self.filename,
+                         os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                size = os.fstat(fd).st_size
+                if size:
+                    os.lseek(fd, -1, os.SEEK_END)
+                if size and os.read(fd, 1) != b'\n':
+                    # terminate the incomplete record of a crashed append
+                    data = b'\n' + data
+                os.write(fd, data)
+                os.fsync(fd)
+                size += len(data)
+            finally:
+                os.close(fd)
+
+            if size > self.max_bytes:
+                self.__evict()
+        finally:
+            self.__unlock(lock)
+
+    def __evict(self):
+        # drop the oldest records until the spool fits again
+        with open(self.filename, 'rb') as f:
+            lines = f.readlines()
+
+        size = sum(len(line) for line in lines)
+        while lines and size > self.max_bytes:
+            size -= len(lines.pop(0))
+
+        atomic_write(self.filename, b''.join(lines), sync=True)
+
+    def __take_file(self, filename):
+        self.replays += 1
+        replay = os.path.join(self.directory, '{0}{1}.{2}'.format(
+            REPLAY_PREFIX, os.getpid(), self.replays))
+        os.rename(filename, replay)
+        self.taken.append(replay)
+
+    def take(self):
+        # Returns the spooled metric data, oldest first. Replay files left
+        # behind by crashed runs are taken over as well, files taken but not
+        # committed yet are read again.
+        lock = self.__lock()
+        try:
+            for name in sorted(os.listdir(self.directory)):
+                if not name.startswith(REPLAY_PREFIX):
+                    continue
+                pid = name[len(REPLAY_PREFIX):].split('.')[0]
+                if pid.isdigit() and not pid_alive(int(pid)):
+                    self.__take_file(os.path.join(self.directory, name))
+
+            if os.path.exists(self.filename):
+                self.__take_file(self.filename)
+        finally:
+            self.__unlock(lock)
+
+        min_timestamp = datetime.datetime.utcnow() - MAX_AGE
+        datums = []
+        for filename in self.taken:
+            with open(filename, 'rb') as f:
+                for line in f:
+                    try:
+                        records = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # incomplete record of a crashed append
+                        continue
+                    for record in records:
+                        datum = MetricDatum.from_dict(record)
+                        if datum.timestamp > min_timestamp:
+                            datums.append(datum)
+
+        datums.sort(key=lambda d: d.timestamp)
+        return datums
+
+    def commit(self):
+        # the taken metric data was sent or spooled again
+        for filename in self.taken:
+            os.remove(filename)
+        self.taken = []
@@ -0,0 +1,241 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import math
+import os
+import random
+import socket
+import threading
+from cloudwatchmon.put_metric_data import AWS_LIMIT_DIMENSIONS_SIZE, \
+    StatisticSet
+
+# a UDP datagram can't be larger
+MAX_PACKET_SIZE = 65535
+
+# SO_RCVBUF is capped by net.core.rmem_max (about 208 KB by default),
+# SO_RCVBUFFORCE (Linux, root) is not
+RECEIVE_BUFFER_SIZE = 4 * 1048576
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+
+# timer values kept per interval for percentiles - count, sum, minimum and
+# maximum are always exact
+TIMER_RESERVOIR_SIZE = 4096
+
+# every metric gets one more dimension (InstanceId, AutoScalingGroupName,
+# InstanceType or ImageId)
+MAX_TAGS = AWS_LIMIT_DIMENSIONS_SIZE - 1
+
+# CloudWatch dimension name and value lengths
+MAX_TAG_KEY_LENGTH = 255
+MAX_TAG_VALUE_LENGTH = 1024
+
+UNITS = {'c': 'Count', 's': 'Count', 'ms': 'Milliseconds', 'h': None,
+         'g': None}
+
+
+def parse_line(line):
+    # name:value|type[|@sample_rate][|#tag:value,...] - returns name, value,
+    # type, sample rate, tags and whether a gauge value is relative (+/-) or
+    # raises ValueError
+    name, sep, rest = line.partition(':')
+    fields = rest.split('|')
+    if not name or not sep or len(fields) < 2 or fields[1] not in UNITS:
+        raise ValueError('Invalid StatsD line: ' + line)
+
+    metric_type = fields[1]
+    value = fields[0]
+    relative = metric_type == 'g' and value[:1] in ('+', '-')
+    if metric_type != 's':
+        value = float(value)
+        if math.isnan(value) or math.isinf(value):
+            raise ValueError('Invalid StatsD value: ' + line)
+
+    sample_rate = 1.0
+    tags = {}
+    for field in fields[2:]:
+        if field.startswith('@'):
+            sample_rate = float(field[1:])
+            if not 0 < sample_rate <= 1:
+                raise ValueError('Invalid StatsD sample rate: ' + line)
+        elif field.startswith('#'):
+            for tag in field[1:].split(','):
+                key, _, tag_value = tag.partition(':')
+                if len(key) > MAX_TAG_KEY_LENGTH or \
+                        len(tag_value) > MAX_TAG_VALUE_LENGTH:
+                    raise ValueError('Invalid StatsD tag: ' + line)
+                if key and tag_value:
+                    tags[key] = tag_value
+
+    if len(tags) > MAX_TAGS:
+        raise ValueError('More than {0} StatsD tags: {1}'
+                         .format(MAX_TAGS, line))
+
+    return name, value, metric_type, sample_rate, tags, relative
+
+
+class Timer:
+    def __init__(self):
+        self.statistics = StatisticSet()
+        self.reservoir = []
+
+    def add(self, value):
+        self.statistics.add(value)
+        if len(self.reservoir) < TIMER_RESERVOIR_SIZE:
+            self.reservoir.append(value)
+        else:
+            idx = random.randint(0, self.statistics.sample_count - 1)
+            if idx < TIMER_RESERVOIR_SIZE:
+                self.reservoir[idx] = value
+
+    def percentiles(self, percentiles):
+        # nearest rank
+        values = sorted(self.reservoir)
+        for p in percentiles:
+            rank = int(math.ceil(p / 100.0 * len(values)))
+            yield p, values[max(rank, 1) - 1]
+
+
+# Aggregates StatsD counters, gauges, timers (and histograms) and sets in
+# memory until they are flushed into Metrics. Gauges keep their value for
+# relative (+/-) updates but are only reported when they were set in the
+# interval. Packets may be added from another thread.
+class StatsdAggregator:
+    def __init__(self, percentiles):
+        self.percentiles = percentiles
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.updated_gauges = set()
+        self.timers = {}
+        self.sets = {}
+        self.invalid = 0
+
+    def add_packet(self, data):
+        lines = []
+        invalid = 0
+        for line in data.decode('utf-8', 'replace').splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                lines.append(parse_line(line))
+            except ValueError:
+                invalid += 1
+
+        with self.lock:
+            for line in lines:
+                self.add(*line)
+            self.invalid += invalid
+
+    def add(self, name, value, metric_type, sample_rate, tags, relative):
+        key = (name, metric_type, tuple(sorted(tags.items())))
+        if metric_type == 'c':
+            self.counters[key] = self.counters.get(key, 0.0) + \
+                value / sample_rate
+        elif metric_type == 'g':
+            if relative:
+                value += self.gauges.get(key, 0.0)
+            self.gauges[key] = value
+            self.updated_gauges.add(key)
+        elif metric_type == 's':
+            self.sets.setdefault(key, set()).add(value)
+        else:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = Timer()
+            timer.add(value)
+
+    def flush(self, metrics):
+        # the interval is swapped out under the lock, packets received
+        # meanwhile count for the next interval
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges = dict((key, self.gauges[key])
+                          for key in self.updated_gauges)
+            self.updated_gauges = set()
+            timers, self.timers = self.timers, {}
+            sets, self.sets = self.sets, {}
+            invalid, self.invalid = self.invalid, 0
+
+        for (name, metric_type, tags), value in counters.items():
+            metrics.add_metric(name, UNITS[metric_type], value,
+                               extra_dims=dict(tags))
+        for (name, metric_type, tags), value in gauges.items():
+            metrics.add_metric(name, UNITS[metric_type], value,
+                               extra_dims=dict(tags))
+        for (name, metric_type, tags), values in sets.items():
+            metrics.add_metric(name, UNITS[metric_type], len(values),
+                               extra_dims=dict(tags))
+        for (name, metric_type, tags), timer in timers.items():
+            unit = UNITS[metric_type]
+            metrics.add_metric(name, unit, timer.statistics,
+                               extra_dims=dict(tags))
+            for p, value in timer.percentiles(self.percentiles):
+                metrics.add_metric('{0}.p{1:g}'.format(name, p), unit, value,
+                                   extra_dims=dict(tags))
+        return invalid
+
+
+def parse_address(address):
+    # unix:PATH or an absolute path for a Unix datagram socket, else
+    # [HOST]:PORT for UDP (an empty host listens on all interfaces)
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('Invalid StatsD address: ' + address)
+    host = host.strip('[]')
+    info = socket.getaddrinfo(host or None, int(port), socket.AF_UNSPEC,
+                              socket.SOCK_DGRAM, 0, socket.AI_PASSIVE)
+    return info[0][0], info[0][4]
+
+
+# Receives StatsD packets into the aggregator on a background thread, so
+# packets are read while metrics are collected and published
+class StatsdListener:
+    def __init__(self, address, aggregator):
+        family, self.address = parse_address(address)
+        self.aggregator = aggregator
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        for option in SO_RCVBUFFORCE, socket.SO_RCVBUF:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option,
+                                     RECEIVE_BUFFER_SIZE)
+                break
+            except socket.error:
+                pass
+        if family == socket.AF_UNIX and os.path.exists(self.address):
+            # socket of a previous run
+            os.remove(self.address)
+        self.sock.bind(self.address)
+
+    def start(self):
+        thread = threading.Thread(target=self.__receive)
+        thread.daemon = True
+        thread.start()
+
+    def __receive(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_PACKET_SIZE)
+            except socket.error as e:
+                if e.errno == errno.EBADF:
+                    return
+                # e.g. EINTR
+                continue
+            self.aggregator.add_packet(data)
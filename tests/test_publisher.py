@@ -0,0 +1,173 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import socket
+import threading
+import time
+import unittest
+from cloudwatchmon.publisher import Publisher, PublishError
+from cloudwatchmon.put_metric_data import Batch, MetricDatum
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+OK = (200, b'<PutMetricDataResponse/>')
+THROTTLED = (400, b'<ErrorResponse><Error><Code>Throttling</Code>'
+                  b'<Message>Rate exceeded</Message></Error></ErrorResponse>')
+UNAVAILABLE = (503, b'<ErrorResponse><Error><Code>ServiceUnavailable</Code>'
+                    b'</Error></ErrorResponse>')
+INVALID = (400, b'<ErrorResponse><Error><Code>InvalidParameterValue</Code>'
+                b'<Message>Bad value</Message></Error></ErrorResponse>')
+
+
+class Credentials:
+    def get_keys(self):
+        return 'AKIDEXAMPLE', 'secret', None
+
+
+# Local stand-in for CloudWatch - answers requests with the responses of
+# the test in order (OK when they are used up)
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests.append(body)
+            response = server.respond(body)
+
+        status, data, delay, close = response
+        time.sleep(delay)
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except socket.error:
+            # the client gave up (read timeout)
+            self.close_connection = True
+            return
+        # closed without "Connection: close" like an idle timeout
+        self.close_connection = close
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.responses = []
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.respond = self.respond
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, body):
+        if self.responses:
+            response = self.responses.pop(0)
+            if callable(response):
+                return response(body)
+            return response
+        return OK + (0, False)
+
+    def publisher(self, **kwargs):
+        publisher = Publisher('eu-west-1',
+                              endpoint_url='http://127.0.0.1:{0}/'.format(
+                                  self.server.server_port), **kwargs)
+        publisher.credentials = Credentials()
+        return publisher
+
+    @staticmethod
+    def batch(name):
+        batch = Batch()
+        batch.datums.append(MetricDatum(name, 'Count', {},
+                                        datetime.datetime.utcnow(), 1))
+        return batch
+
+    def test_throttling_is_retried(self):
+        self.responses = [THROTTLED + (0, False)]
+        self.publisher().call('PutMetricData', {'Namespace': 'Test'})
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_server_error_is_retried(self):
+        self.responses = [UNAVAILABLE + (0, False)] * 2
+        self.publisher().call('PutMetricData', {'Namespace': 'Test'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_are_limited(self):
+        self.responses = [UNAVAILABLE + (0, False)] * 3
+        with self.assertRaises(PublishError) as cm:
+            self.publisher(max_retries=1).call('PutMetricData', {})
+        self.assertEqual(cm.exception.status, 503)
+        self.assertTrue(cm.exception.retryable)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_client_error_fails_its_batch_only(self):
+        def respond(body):
+            if b'MetricName=Bad' in body:
+                return INVALID + (0, False)
+            return OK + (0, False)
+        self.responses = [respond] * 3
+
+        batches = [self.batch('Good1'), self.batch('Bad'),
+                   self.batch('Good2')]
+        failed = self.publisher(connections=2).send(batches, 'Test')
+
+        self.assertEqual(len(failed), 1)
+        batch, error = failed[0]
+        self.assertIs(batch, batches[1])
+        self.assertEqual(error.status, 400)
+        self.assertEqual(error.code, 'InvalidParameterValue')
+        self.assertFalse(error.retryable)
+        # not retried
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_read_timeout(self):
+        self.responses = [OK + (1.0, False)]
+        start = time.time()
+        with self.assertRaises(PublishError) as cm:
+            self.publisher(read_timeout=0.2, max_retries=0) \
+                .call('PutMetricData', {})
+        self.assertTrue(cm.exception.retryable)
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_closed_keep_alive_connection_is_not_an_attempt(self):
+        self.responses = [OK + (0, True)]
+        publisher = self.publisher(connections=1, max_retries=0)
+        publisher.call('PutMetricData', {})
+        # give the server time to close the idle connection
+        time.sleep(0.1)
+        publisher.call('PutMetricData', {})
+        self.assertEqual(len(self.server.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
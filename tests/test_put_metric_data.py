@@ -0,0 +1,137 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+from cloudwatchmon.put_metric_data import AWS_LIMIT_VALUES_SIZE, \
+    REQUEST_OVERHEAD_BYTES, BatchPacker, MetricDatum, StatisticSet, pack
+
+TIMESTAMP = datetime.datetime(2020, 1, 1, 12, 0, 0)
+
+
+def datum(value, name='Metric', dims=None):
+    return MetricDatum(name, 'Count', dims or {'InstanceId': 'i-1'},
+                       TIMESTAMP, value)
+
+
+def spooled(values, counts=None, name='Metric'):
+    # multi-valued datum as replayed from the spool
+    return MetricDatum.from_dict({
+        'name': name, 'unit': 'Count', 'dimensions': {'InstanceId': 'i-1'},
+        'timestamp': TIMESTAMP.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'values': values, 'counts': counts or [1] * len(values)})
+
+
+def statistics(*values):
+    s = StatisticSet()
+    for value in values:
+        s.add(value)
+    return s
+
+
+def samples(batches):
+    # value -> count of all packed data
+    result = {}
+    for batch in batches:
+        for d in batch.datums:
+            for value, count in zip(d.values, d.counts):
+                result[value] = result.get(value, 0) + count
+    return result
+
+
+class BatchPackerTest(unittest.TestCase):
+    def test_same_metric_is_merged(self):
+        batches = pack([datum(1), datum(2), datum(1)])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 1)
+        d = batches[0].datums[0]
+        self.assertEqual(d.values, [1.0, 2.0])
+        self.assertEqual(d.counts, [2, 1])
+
+    def test_multi_valued_data_is_merged(self):
+        batches = pack([spooled([1, 2]), spooled([3, 4, 5], [1, 2, 1])])
+        self.assertEqual(len(batches[0]), 1)
+        d = batches[0].datums[0]
+        self.assertEqual(d.values, [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(d.counts, [1, 1, 1, 2, 1])
+
+    def test_multi_valued_merge_adds_counts(self):
+        batches = pack([spooled([1, 2], [3, 1]), spooled([2, 1], [5, 1])])
+        d = batches[0].datums[0]
+        self.assertEqual(d.values, [1.0, 2.0])
+        self.assertEqual(d.counts, [4, 6])
+
+    def test_values_are_split_at_limit(self):
+        count = AWS_LIMIT_VALUES_SIZE + 10
+        batches = pack([datum(v) for v in range(count)])
+        self.assertEqual(len(batches), 1)
+        data = batches[0].datums
+        self.assertEqual([len(d.values) for d in data],
+                         [AWS_LIMIT_VALUES_SIZE, 10])
+        self.assertEqual(samples(batches),
+                         dict((float(v), 1) for v in range(count)))
+
+    def test_multi_valued_data_is_split_at_limit(self):
+        first = spooled(list(range(100)))
+        second = spooled(list(range(90, 190)))
+        batches = pack([first, second])
+        data = batches[0].datums
+        self.assertEqual(len(data), 2)
+        for d in data:
+            self.assertLessEqual(len(d.values), AWS_LIMIT_VALUES_SIZE)
+        self.assertEqual(sum(samples(batches).values()), 200)
+
+    def test_statistic_sets_are_merged(self):
+        batches = pack([datum(statistics(1, 5)), datum(statistics(3)),
+                        datum(7)])
+        data = batches[0].datums
+        self.assertEqual(len(data), 2)
+        s = data[0].statistics
+        self.assertEqual((s.sample_count, s.sum, s.minimum, s.maximum),
+                         (3, 9.0, 1.0, 5.0))
+        self.assertEqual(data[1].values, [7.0])
+
+    def test_metric_count_limit(self):
+        packer = BatchPacker(max_metrics=3)
+        batches = []
+        for i in range(7):
+            batches.extend(packer.add(datum(1, name='M{0}'.format(i))))
+        batches.extend(packer.flush())
+        self.assertEqual([len(b) for b in batches], [3, 3, 1])
+
+    def test_byte_limit(self):
+        data = [datum(1, name='M{0}'.format(i)) for i in range(20)]
+        max_bytes = REQUEST_OVERHEAD_BYTES + data[0].size * 5
+        packer = BatchPacker(max_bytes=max_bytes)
+        batches = []
+        for d in data:
+            batches.extend(packer.add(d))
+        batches.extend(packer.flush())
+        self.assertEqual(sum(len(b) for b in batches), 20)
+        for batch in batches:
+            self.assertLessEqual(batch.size, max_bytes)
+            self.assertLessEqual(len(batch), 5)
+
+    def test_merge_respects_byte_limit(self):
+        first = datum(1)
+        packer = BatchPacker(max_bytes=REQUEST_OVERHEAD_BYTES + first.size)
+        batches = packer.add(first)
+        batches.extend(packer.add(datum(2)))
+        batches.extend(packer.flush())
+        self.assertEqual([len(b) for b in batches], [1, 1])
+        self.assertEqual(samples(batches), {1.0: 1, 2.0: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
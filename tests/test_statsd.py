@@ -0,0 +1,57 @@
+# Copyright 2015 Oliver Siegmar
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+from cloudwatchmon.cli.put_instance_stats import Metrics
+from cloudwatchmon.statsd import MAX_TAGS, StatsdAggregator, parse_line
+
+
+def tagged(count):
+    return 'requests:1|c|#' + ','.join('t{0}:v'.format(i)
+                                       for i in range(count))
+
+
+class StatsdTest(unittest.TestCase):
+    def test_parse_line(self):
+        self.assertEqual(parse_line('latency:12.5|ms|@0.5|#host:a,db:b'),
+                         ('latency', 12.5, 'ms', 0.5,
+                          {'host': 'a', 'db': 'b'}, False))
+
+    def test_too_many_tags_are_invalid(self):
+        parse_line(tagged(MAX_TAGS))
+        self.assertRaises(ValueError, parse_line, tagged(MAX_TAGS + 1))
+
+    def test_too_long_tags_are_invalid(self):
+        self.assertRaises(ValueError, parse_line,
+                          'requests:1|c|#host:' + 'x' * 1025)
+        self.assertRaises(ValueError, parse_line,
+                          'requests:1|c|#' + 'x' * 256 + ':a')
+
+    def test_invalid_line_does_not_fail_the_interval(self):
+        aggregator = StatsdAggregator([90.0])
+        aggregator.add_packet('\n'.join([
+            tagged(MAX_TAGS + 1), tagged(MAX_TAGS), 'errors:2|c'])
+            .encode('utf-8'))
+
+        metrics = Metrics('eu-west-1', 'i-1', 't3.micro', 'ami-1', 'only',
+                          'web')
+        self.assertEqual(aggregator.flush(metrics), 1)
+        datums = metrics.datums(datetime.datetime.utcnow())
+        self.assertEqual(sorted(set(d.name for d in datums)),
+                         ['errors', 'requests'])
+
+
+if __name__ == '__main__':
+    unittest.main()